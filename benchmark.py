@@ -0,0 +1,221 @@
+# 性能基准：生成可复现的模拟比赛数据，在不同数据规模下测量主页、比赛详情和年度报告的耗时、SQL 查询数与峰值内存
+#
+# 用法：
+#   python benchmark.py                                  # 默认规模 100 / 1000 / 10000 场
+#   python benchmark.py --sizes 100 1000 --output before.json
+#   python benchmark.py --output after.json --compare before.json
+#
+# 基准使用临时数据库，不会读写 instance/guandan.db。
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# 创建比赛页面（create_match.html）中的默认积分规则；12 人局页面没有默认值，这里按同样的递减方式补齐
+DEFAULT_POINTS = {
+    4: [14, 8, 4, 0],
+    6: [20, 16, 12, 8, 4, 0],
+    8: [30, 24, 20, 16, 12, 8, 4, 0],
+    10: [50, 42, 36, 30, 24, 18, 12, 8, 4, 0],
+    12: [60, 50, 42, 36, 30, 24, 18, 12, 8, 4, 2, 0],
+}
+LOCATIONS = ['老地方', '茶馆', '小区活动室', '公司会议室', '朋友家']
+
+
+def generate_matches(fa, count, rng, years, pool_size=60):
+    # 直接批量写入原始成绩表（比逐轮走表单快几个数量级），再由 rebuild_match_results 生成汇总表与级牌记录
+    db = fa.db
+    names = [f'选手{i + 1:03d}' for i in range(pool_size)]
+    person_ids = [fa.get_or_create_person(name).id for name in names]
+
+    next_id = {model: (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+               for model in (fa.Match, fa.Player, fa.ScoreRule, fa.RoundScore)}
+    matches, players, rules, scores = [], [], [], []
+    for _ in range(count):
+        match_id = next_id[fa.Match]
+        next_id[fa.Match] += 1
+        player_count = rng.choice(sorted(DEFAULT_POINTS))
+        points = DEFAULT_POINTS[player_count]
+        match_time = datetime.datetime(rng.choice(years), rng.randint(1, 12), rng.randint(1, 28),
+                                       rng.randint(9, 22), rng.choice([0, 30]))
+        matches.append({'id': match_id, 'player_count': player_count, 'time': match_time,
+                        'location': rng.choice(LOCATIONS),
+                        'status': 'finished' if rng.random() < 0.9 else 'ongoing'})
+
+        player_ids = []
+        for number, person in enumerate(rng.sample(range(pool_size), player_count), start=1):
+            player_ids.append(next_id[fa.Player])
+            players.append({'id': next_id[fa.Player], 'match_id': match_id, 'person_id': person_ids[person],
+                            'player_number': number, 'name': names[person],
+                            'team': 1 if number % 2 == 1 else 2})
+            next_id[fa.Player] += 1
+        for rank, value in enumerate(points, start=1):
+            rules.append({'id': next_id[fa.ScoreRule], 'match_id': match_id, 'rank': rank, 'points': value})
+            next_id[fa.ScoreRule] += 1
+
+        for round_number in range(1, rng.randint(3, 15) + 1):
+            order = player_ids[:]
+            rng.shuffle(order)
+            for rank, player_id in enumerate(order, start=1):
+                scores.append({'id': next_id[fa.RoundScore], 'match_id': match_id, 'round_number': round_number,
+                               'player_id': player_id, 'rank': rank, 'points': points[rank - 1]})
+                next_id[fa.RoundScore] += 1
+
+    for model, rows in ((fa.Match, matches), (fa.Player, players), (fa.ScoreRule, rules), (fa.RoundScore, scores)):
+        if rows:
+            db.session.execute(model.__table__.insert(), rows)
+    match_ids = [row['id'] for row in matches]
+    for start in range(0, len(match_ids), 500):
+        fa.rebuild_match_results(match_ids[start:start + 500])
+    db.session.commit()
+    fa.report_cache.clear()
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        from sqlalchemy import event
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def measure(client, counter, url, repeat, before=None):
+    # 先计时（不开启 tracemalloc，避免其开销计入耗时），再单独请求一次统计查询数与峰值内存
+    timings = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        response = client.get(url)
+        timings.append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError(f'{url} 返回 {response.status_code}')
+
+    if before:
+        before()
+    counter.count = 0
+    tracemalloc.start()
+    client.get(url)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'url': url,
+        'median_ms': round(statistics.median(timings), 3),
+        'min_ms': round(min(timings), 3),
+        'max_ms': round(max(timings), 3),
+        'queries': counter.count,
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def run_size(fa, client, counter, size, rng, repeat):
+    with fa.app.app_context():
+        rows = fa.db.session.query(fa.Match.id, fa.MatchResult.rounds, fa.Match.time) \
+            .join(fa.MatchResult, fa.MatchResult.match_id == fa.Match.id).all()
+        year_counts = {}
+        for _, _, match_time in rows:
+            year_counts[match_time.year] = year_counts.get(match_time.year, 0) + 1
+        busiest_year = max(year_counts, key=year_counts.get)
+        # 比赛详情取轮数最多的一场（最坏情况）和随机一场
+        longest = max(rows, key=lambda row: row[1])[0]
+        sample = rng.choice(rows)[0]
+
+    routes = {
+        'index': measure(client, counter, '/', repeat),
+        'match_detail_longest': measure(client, counter, f'/match/{longest}', repeat),
+        'match_detail_sample': measure(client, counter, f'/match/{sample}', repeat),
+        'annual_report_cold': measure(client, counter, f'/annual_report?year={busiest_year}', repeat,
+                                      before=fa.report_cache.clear),
+        'annual_report_cached': measure(client, counter, f'/annual_report?year={busiest_year}', repeat),
+        'multi_year_report': measure(client, counter, '/multi_year_report', repeat),
+    }
+    return {'matches': size, 'annual_report_year': busiest_year,
+            'annual_report_year_matches': year_counts[busiest_year], 'routes': routes}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    # 按 (数据规模, 路由) 对比中位耗时与查询数
+    previous = {(entry['matches'], name): route
+                for entry in baseline['sizes'] for name, route in entry['routes'].items()}
+    print(f"\n与 {baseline.get('commit') or '基线'} 对比：")
+    for entry in results['sizes']:
+        for name, route in entry['routes'].items():
+            old = previous.get((entry['matches'], name))
+            if old is None:
+                continue
+            ratio = route['median_ms'] / old['median_ms'] if old['median_ms'] else float('inf')
+            print(f"  {entry['matches']:>6} 场 {name:<22} {old['median_ms']:>9.2f} -> {route['median_ms']:>9.2f} ms"
+                  f" (x{ratio:.2f})  查询 {old['queries']} -> {route['queries']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='掼蛋比赛记录系统性能基准')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='依次测量的比赛场数')
+    parser.add_argument('--years', type=int, nargs='+', default=[2023, 2024, 2025], help='模拟数据覆盖的年份')
+    parser.add_argument('--repeat', type=int, default=5, help='每个路由重复请求的次数')
+    parser.add_argument('--seed', type=int, default=2025, help='随机种子，相同种子生成相同的数据')
+    parser.add_argument('--output', default='bench_results.json', help='结果 JSON 文件')
+    parser.add_argument('--compare', help='与之前保存的结果 JSON 对比')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='guandan-bench-')
+    os.environ['GUANDAN_DATABASE_URI'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import flask_app as fa
+
+    rng = random.Random(args.seed)
+    client = fa.app.test_client()
+    with fa.app.app_context():
+        counter = QueryCounter(fa.db.engine)
+
+    results = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'sizes': [],
+    }
+    generated = 0
+    for size in sorted(args.sizes):
+        start = time.perf_counter()
+        with fa.app.app_context():
+            generate_matches(fa, size - generated, rng, args.years)
+        generated = size
+        print(f'{size} 场比赛数据生成完成（{time.perf_counter() - start:.1f} 秒）')
+        entry = run_size(fa, client, counter, size, rng, args.repeat)
+        entry['database_bytes'] = os.path.getsize(os.path.join(workdir, 'bench.db'))
+        results['sizes'].append(entry)
+        for name, route in entry['routes'].items():
+            print(f"  {name:<22} 中位 {route['median_ms']:>9.2f} ms  查询 {route['queries']:>4}  "
+                  f"峰值内存 {route['peak_memory_kb']:>9.1f} KB")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f'结果已写入 {args.output}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
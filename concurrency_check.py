@@ -0,0 +1,114 @@
+# 并发检查：一个写连接持有数据库写锁（模拟录入成绩的事务正在提交）期间，多个读线程持续请求比赛页面，
+# 分别在默认的回滚日志模式和生产配置的 WAL 模式下统计读请求的最长耗时与失败数。
+#
+# 用法：python concurrency_check.py [--hold 2] [--readers 8]
+#
+# 预期结果：回滚日志模式下读请求要等写锁释放（超过 busy_timeout 时报 database is locked）；
+# WAL 模式下读请求不受影响，最长耗时远小于持锁时间。WAL 模式下读请求被阻塞时以非零状态退出。
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+
+def create_sample_match(client, fa):
+    form = {'player_count': 8, 'time': '2025-06-01T20:00', 'location': '并发检查'}
+    for i in range(1, 9):
+        form[f'player_{i}'] = f'选手{i}'
+        form[f'points_{i}'] = [30, 24, 20, 16, 12, 8, 4, 0][i - 1]
+    client.post('/create_match', data=form)
+    with fa.app.app_context():
+        match = fa.Match.query.order_by(fa.Match.id.desc()).first()
+        player_ids = [player.id for player in match.players]
+    for _ in range(5):
+        data = {'submit_scores': '1'}
+        for rank, player_id in enumerate(player_ids, start=1):
+            data[f'player_{rank}'] = player_id
+        client.post(f'/match/{match.id}', data=data)
+    return match.id
+
+
+def run_mode(fa, database, match_id, journal_mode, hold, readers):
+    fa.app.config['SQLITE_PRAGMAS'] = dict(fa.PRODUCTION_CONFIG['SQLITE_PRAGMAS'], journal_mode=journal_mode,
+                                           busy_timeout=int(hold * 1000 / 2))
+    with fa.app.app_context():
+        fa.db.engine.dispose()  # 之后新建的连接使用新的 PRAGMA
+    check = sqlite3.connect(database)
+    check.execute(f'PRAGMA journal_mode = {journal_mode}')
+    check.close()
+
+    writer_ready = threading.Event()
+    writer_done = threading.Event()
+
+    def writer():
+        # 与 submit_round 相同的写入，但在提交前持有写锁 hold 秒
+        conn = sqlite3.connect(database, isolation_level=None)
+        conn.execute('BEGIN EXCLUSIVE')
+        conn.execute('UPDATE match_result SET team1_score = team1_score WHERE match_id = ?', (match_id,))
+        writer_ready.set()
+        time.sleep(hold)
+        conn.execute('ROLLBACK')
+        conn.close()
+        writer_done.set()
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def reader():
+        client = fa.app.test_client()
+        writer_ready.wait()
+        while not writer_done.is_set():
+            for url in (f'/api/match/{match_id}', f'/match/{match_id}'):
+                start = time.perf_counter()
+                try:
+                    status = client.get(url).status_code
+                except Exception as e:  # 读请求在锁上超时
+                    status = type(e).__name__
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    if status != 200:
+                        errors.append(status)
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'requests': len(latencies), 'errors': len(errors),
+            'max_ms': max(latencies) * 1000 if latencies else 0,
+            'median_ms': sorted(latencies)[len(latencies) // 2] * 1000 if latencies else 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='检查录入成绩时读请求是否被阻塞')
+    parser.add_argument('--hold', type=float, default=2.0, help='写连接持有写锁的秒数')
+    parser.add_argument('--readers', type=int, default=8, help='并发读线程数')
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(prefix='guandan-concurrency-'), 'check.db')
+    os.environ['GUANDAN_DATABASE_URI'] = f'sqlite:///{database}'
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import flask_app as fa
+    fa.app.logger.disabled = True
+    match_id = create_sample_match(fa.app.test_client(), fa)
+
+    results = {}
+    for journal_mode in ('DELETE', 'WAL'):
+        results[journal_mode] = run_mode(fa, database, match_id, journal_mode, args.hold, args.readers)
+        result = results[journal_mode]
+        print(f"{journal_mode:<6} 持锁 {args.hold:.1f} 秒期间：读请求 {result['requests']} 次，失败 {result['errors']} 次，"
+              f"中位 {result['median_ms']:.1f} ms，最长 {result['max_ms']:.1f} ms")
+
+    wal = results['WAL']
+    if wal['errors'] or wal['max_ms'] >= args.hold * 1000 / 2:
+        print('WAL 模式下读请求被写事务阻塞')
+        sys.exit(1)
+    print('WAL 模式下读请求未被写事务阻塞')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,275 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context, \
+    g, abort, has_app_context, has_request_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from markupsafe import Markup
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import aliased, joinedload, selectinload
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+import click
+import csv
 import datetime
+import gzip
+import hmac
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///guandan.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('GUANDAN_DATABASE_URI', 'sqlite:///guandan.db')  # 可通过环境变量指定其他数据库
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.secret_key = 'your_secret_key'
+app.secret_key = os.environ.get('GUANDAN_SECRET_KEY', 'your_secret_key')
+app.config['REPORT_CACHE_SIZE'] = 20  # 年度报告缓存最多保留的年份数（任意 ?year= 都会占用一项，必须有上限），None 表示不限
+app.config['ROUND_FRAGMENT_CACHE_SIZE'] = 5000  # 比赛详情页缓存的轮次成绩表数量
+app.config['MATCHES_PER_PAGE'] = 20  # 主页比赛列表每页场次
+app.config['LIVE_POLL_TIMEOUT'] = 30  # 长轮询 / SSE 单次连接最长等待秒数
+app.config['LIVE_RECHECK_INTERVAL'] = 5  # 等待期间重新检查数据库的间隔（发现其他进程写入的变化）
+app.config['REQUEST_PROFILING'] = os.environ.get('GUANDAN_REQUEST_PROFILING') == '1'  # 记录每个请求的 SQL 与耗时分布
+app.config['REQUEST_PROFILE_HISTORY'] = 200  # 诊断接口保留最近多少个请求的记录
+app.config['DIAGNOSTICS_TOKEN'] = os.environ.get('GUANDAN_DIAGNOSTICS_TOKEN')  # 访问 /_diagnostics/requests 需携带的令牌，未设置时不开放
+app.config['SQLITE_PRAGMAS'] = {}  # 每个 SQLite 连接建立时执行的 PRAGMA
+app.config['REPORT_BACKGROUND'] = os.environ.get('GUANDAN_REPORT_BACKGROUND') == '1'  # 报告在后台线程计算，页面轮询任务状态
+app.config['REPORT_WORKERS'] = 2  # 后台计算报告的线程数
+app.config['REPORT_JOB_TIMEOUT'] = 600  # 超过该秒数仍未完成的任务视为失败（例如所在进程已退出），可以重新提交
+app.config['REPORT_PRECOMPUTE_ON_FINISH'] = False  # 后台模式下结束比赛后立即预先计算该年度报告
+app.config['SIMULATION_COUNT'] = 10000  # 胜率预测默认的模拟次数
+app.config['SIMULATION_MAX'] = 100000  # 接口允许的最大模拟次数（更大规模用 simulate-match 命令）
+app.config['SIMULATION_CHUNK'] = 20000  # 每块模拟次数，限制单块数组大小，也是进程池分块的单位
+app.config['SIMULATION_DEFAULT_ROUNDS'] = 8  # 没有同人数历史比赛时假定的全场轮数
+app.config['SIMULATION_HISTORY_MATCHES'] = 50  # 按历史名次抽样时统计每位选手最近多少场比赛
+app.config['BALANCE_PRIOR_MATCHES'] = 5  # 平衡分队时胜率向 50% 收缩的虚拟场数，场次少的选手 / 组合更接近 50%
+app.config['BALANCE_CHUNK'] = 20000  # 分队搜索每块评估的方案数，也是进程池分块的单位
+app.config['RATING_INITIAL'] = 1500  # 新选手的初始等级分
+app.config['RATING_K_FACTOR'] = 32  # 每场比赛等级分变化的上限（Elo K 值）
+app.config['CLUB_DIRECTORY'] = os.environ.get('GUANDAN_CLUB_DIRECTORY')  # 多俱乐部：每个俱乐部一个 SQLite 文件的目录（相对路径位于 instance 目录下），None 表示只用默认数据库
+app.config['CLUB_DOMAIN'] = os.environ.get('GUANDAN_CLUB_DOMAIN')  # 设置后 <俱乐部>.<域名> 的请求也路由到该俱乐部
+app.config['CLUB_FANOUT_WORKERS'] = 4  # 跨俱乐部排行榜 / 报告并行查询各俱乐部数据库的线程数
+app.config['REPORT_MAX_YEARS'] = 50  # 生涯报告最多统计的年数，区间更长时只统计最近的这些年
+app.config['REPORT_CACHE_VALIDATE'] = False  # 命中年度报告缓存时是否核对该年数据指纹（多进程部署时其他进程的写入不会清除本进程缓存）
 
-db = SQLAlchemy(app)
+# 生产环境配置（GUANDAN_CONFIG=production，wsgi.py 默认启用）：多进程 WSGI 下 SQLite 使用 WAL 模式，
+# 录入成绩时查看页面的读请求不会被写事务阻塞；写请求之间遇到锁时等待 busy_timeout 而不是立即报错
+PRODUCTION_CONFIG = {
+    'DEBUG': False,
+    'SQLITE_PRAGMAS': {
+        'busy_timeout': 5000,  # 放在最前面，之后的 PRAGMA 遇到锁时同样会等待
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # WAL 模式下 NORMAL 不会损坏数据库，只是断电时可能丢失最后几个事务
+        'temp_store': 'MEMORY',
+    },
+    'SQLALCHEMY_ENGINE_OPTIONS': {
+        'pool_size': 10,  # 长轮询 / SSE 等待期间会归还连接，连接池按同时执行查询的请求数设置即可
+        'max_overflow': 10,
+        'pool_timeout': 10,
+    },
+    'REPORT_CACHE_VALIDATE': True,
+}
+if os.environ.get('GUANDAN_CONFIG') == 'production':
+    app.config.update(PRODUCTION_CONFIG)
+
+# 多俱乐部：请求所属的俱乐部保存在 g.club（由 URL 前缀或子域名确定，见"多俱乐部"一节），
+# 会话执行每条语句时按俱乐部选择对应的数据库，不属于任何俱乐部的请求和命令行使用默认数据库
+def current_club():
+    return g.get('club') if has_app_context() else None
+
+class ClubSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        club = current_club()
+        if bind is None and club is not None:
+            return club_registry.engine(club)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': ClubSession})
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+PROFIT_CAP = 88  # 收益/亏损按两队积分差计算，88封顶
+LEVEL_CARDS = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']  # 级牌，初始为 '2'（索引 0）
+
+# 年度报告缓存：按 (俱乐部, 年份) 保存 (数据指纹, 模板上下文)，该年度比赛有写入时失效
+class ReportCache:
+    def __init__(self, size_config):
+        self.size_config = size_config  # 容量的配置项名，每次写入时读取，运行中修改配置即可生效
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            max_size = app.config[self.size_config]
+            while max_size is not None and len(self._entries) > max_size:
+                self._entries.popitem(last=False)  # 淘汰最久未使用的年份
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': app.config[self.size_config],
+                'keys': list(self._entries.keys()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0,
+            }
+
+report_cache = ReportCache('REPORT_CACHE_SIZE')
+# 比赛详情页每轮成绩表的渲染结果：按 (俱乐部, 比赛 id, 轮次) 保存 (比赛时间, HTML)，同样按最近使用淘汰
+round_fragments = ReportCache('ROUND_FRAGMENT_CACHE_SIZE')
+
+def invalidate_report(match_time):
+    if match_time is not None:
+        report_cache.invalidate((current_club(), match_time.year))
+
+# 比赛有新成绩或状态变化时唤醒本进程内等待中的长轮询 / SSE 连接
+class UpdateNotifier:
+    def __init__(self):
+        self.version = 0
+        self._condition = threading.Condition()
+
+    def notify(self):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, version, timeout):
+        # 等待 version 之后的下一次通知，超时返回；返回当前版本号
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+match_updates = UpdateNotifier()
+
+# === 请求性能分析 ===
+# 开启 REQUEST_PROFILING 后，每个请求记录 SQL 条数、数据库耗时、最慢的语句、重复执行的语句（N+1 查询）
+# 以及 Python 计算与模板渲染各自的耗时，写入日志并可通过 /_diagnostics/requests 查看
+request_profiles = deque()  # 第一次记录时按 REQUEST_PROFILE_HISTORY 设置长度，配置修改后随之调整
+request_profiles_lock = threading.Lock()
+# 单独的子日志器固定为 INFO 级别：运行中开启 REQUEST_PROFILING 时，即使应用日志器为 WARNING（生产环境默认）也会输出
+profile_logger = logging.getLogger(f'{app.logger.name}.profile')
+profile_logger.setLevel(logging.INFO)
+
+def current_profile():
+    return g.get('profile') if has_request_context() else None
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def profile_before_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def profile_after_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    if profile is not None and conn.info.get('query_start'):
+        profile['queries'].append((statement, (time.perf_counter() - conn.info['query_start'].pop()) * 1000))
+
+@before_render_template.connect_via(app)
+def profile_before_render(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None:
+        profile['render_start'] = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def profile_after_render(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None and 'render_start' in profile:
+        profile['render_ms'] += (time.perf_counter() - profile.pop('render_start')) * 1000
+
+@app.before_request
+def start_request_profile():
+    if app.config['REQUEST_PROFILING']:
+        g.profile = {'start': time.perf_counter(), 'queries': [], 'render_ms': 0}
+
+@app.after_request
+def finish_request_profile(response):
+    global request_profiles
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    total_ms = (time.perf_counter() - profile['start']) * 1000
+    db_ms = sum(duration for _, duration in profile['queries'])
+    repeated = Counter(statement for statement, _ in profile['queries'])
+    summary = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'total_ms': round(total_ms, 3),
+        'query_count': len(profile['queries']),
+        'db_ms': round(db_ms, 3),
+        'render_ms': round(profile['render_ms'], 3),
+        'python_ms': round(max(total_ms - db_ms - profile['render_ms'], 0), 3),
+        'slowest_queries': [{'ms': round(duration, 3), 'sql': ' '.join(statement.split())[:300]}
+                            for statement, duration in sorted(profile['queries'], key=lambda q: q[1], reverse=True)[:5]],
+        'repeated_queries': [{'count': count, 'sql': ' '.join(statement.split())[:300]}
+                             for statement, count in repeated.most_common() if count > 1],
+    }
+    with request_profiles_lock:
+        if request_profiles.maxlen != app.config['REQUEST_PROFILE_HISTORY']:
+            request_profiles = deque(request_profiles, maxlen=app.config['REQUEST_PROFILE_HISTORY'])
+        request_profiles.append(summary)
+    log_fields = {key: summary[key] for key in ('method', 'path', 'status', 'total_ms', 'query_count',
+                                                 'db_ms', 'render_ms', 'python_ms')}
+    log_fields['repeated_queries'] = len(summary['repeated_queries'])
+    profile_logger.info('request_profile %s', json.dumps(log_fields, ensure_ascii=False))
+    response.headers['Server-Timing'] = (f"db;dur={summary['db_ms']};desc=\"{summary['query_count']} queries\", "
+                                         f"render;dur={summary['render_ms']}, app;dur={summary['python_ms']}")
+    return response
+
+@app.route('/_diagnostics/requests')
+def diagnostics_requests():
+    # 只在开启性能分析并设置了 DIAGNOSTICS_TOKEN 时提供，请求需带 X-Diagnostics-Token 头（不用查询参数，以免令牌写入日志；
+    # 反向代理后所有请求都来自本机，不能按来源地址判断）；?path= 按路径前缀过滤
+    token = app.config['DIAGNOSTICS_TOKEN']
+    if not app.config['REQUEST_PROFILING'] or not token:
+        return jsonify({'error': '未开启 REQUEST_PROFILING 或未设置 DIAGNOSTICS_TOKEN'}), 404
+    supplied = request.headers.get('X-Diagnostics-Token', '')
+    if not hmac.compare_digest(supplied.encode(), token.encode()):
+        return jsonify({'error': '令牌无效'}), 403
+    prefix = request.args.get('path', '')
+    with request_profiles_lock:
+        profiles = [profile for profile in request_profiles
+                    if profile['path'].startswith(prefix) and profile['endpoint'] != 'diagnostics_requests']
+    return jsonify({'requests': profiles[::-1]})
 
 class Match(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -15,19 +277,32 @@ class Match(db.Model):
     time = db.Column(db.DateTime)
     location = db.Column(db.String(100))
     status = db.Column(db.String(20), default='ongoing')
-    players = db.relationship('Player', backref='match', lazy=True, cascade="all, delete-orphan")
-    scores = db.relationship('RoundScore', backref='match', lazy=True, cascade="all, delete-orphan")
+    players = db.relationship('Player', backref='match', lazy=True, cascade="all, delete-orphan", order_by='Player.id')
+    scores = db.relationship('RoundScore', backref='match', lazy=True, cascade="all, delete-orphan", order_by='RoundScore.id')
+    # 比赛 id 不复用：删除最新一场比赛后新建的比赛不会拿到同一个 id，按 id 缓存的内容（轮次成绩表、ETag）不会对应到别的比赛。
+    # (时间倒序, id) 索引与主页列表的排序一致，游标分页直接按索引顺序读取，不需要临时排序；按时间区间的查询同样使用它
+    __table_args__ = (
+        db.Index('ix_match_time_id', time.desc(), id),
+        {'sqlite_autoincrement': True},
+    )
+
+# 选手身份：跨比赛标识同一个人，各场比赛的 Player 通过 person_id 关联
+class Person(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True)
+    players = db.relationship('Player', backref='person', lazy=True)
 
 class Player(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    match_id = db.Column(db.Integer, db.ForeignKey('match.id'))
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), index=True)
+    person_id = db.Column(db.Integer, db.ForeignKey('person.id'), index=True)
     player_number = db.Column(db.Integer)
-    name = db.Column(db.String(50))
+    name = db.Column(db.String(50), index=True)
     team = db.Column(db.Integer)
 
 class ScoreRule(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    match_id = db.Column(db.Integer, db.ForeignKey('match.id'))
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), index=True)
     rank = db.Column(db.Integer)
     points = db.Column(db.Integer)
 
@@ -35,69 +310,1197 @@ class RoundScore(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     match_id = db.Column(db.Integer, db.ForeignKey('match.id'))
     round_number = db.Column(db.Integer)
-    player_id = db.Column(db.Integer, db.ForeignKey('player.id'))
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), index=True)
     rank = db.Column(db.Integer)
     points = db.Column(db.Integer)
     player = db.relationship('Player', backref='scores')
+    __table_args__ = (
+        db.Index('uq_round_score_match_round_rank', 'match_id', 'round_number', 'rank', unique=True),
+    )
+
+# 每场比赛的汇总结果（录入成绩时增量维护，结束比赛时定稿）
+class MatchResult(db.Model):
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), primary_key=True)
+    rounds = db.Column(db.Integer, default=0)
+    team1_score = db.Column(db.Integer, default=0)
+    team2_score = db.Column(db.Integer, default=0)
+    winning_team = db.Column(db.Integer)  # None 表示平局
+    profit_diff = db.Column(db.Integer, default=0)  # 两队积分差（88封顶）
+    finalized = db.Column(db.Boolean, default=False)
+    team1_level = db.Column(db.Integer, default=0)  # 当前级牌索引（LEVEL_CARDS）
+    team2_level = db.Column(db.Integer, default=0)
+    match = db.relationship('Match', backref=db.backref('result', uselist=False, cascade="all, delete-orphan"))
+
+    @property
+    def team_scores(self):
+        return {1: self.team1_score, 2: self.team2_score}
+
+    @property
+    def team_levels(self):
+        return {1: self.team1_level, 2: self.team2_level}
+
+# 每场比赛的逐轮记录（录入成绩时追加）：级牌变化、两队本轮得分与累计总分
+class MatchRound(db.Model):
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), primary_key=True)
+    round_number = db.Column(db.Integer, primary_key=True)
+    leading_team = db.Column(db.Integer)  # 本轮第一名所在队伍
+    level_advance = db.Column(db.Integer, default=0)  # 本轮升级数（完全领先人数）
+    team1_level = db.Column(db.Integer, default=0)
+    team2_level = db.Column(db.Integer, default=0)
+    team1_points = db.Column(db.Integer, default=0)  # 本轮两队得分
+    team2_points = db.Column(db.Integer, default=0)
+    team1_score = db.Column(db.Integer, default=0)  # 本轮结束后两队累计总分
+    team2_score = db.Column(db.Integer, default=0)
+    match = db.relationship('Match', backref=db.backref('match_rounds', lazy=True, cascade="all, delete-orphan",
+                                                        order_by='MatchRound.round_number'))
+
+    @property
+    def lead(self):
+        # 本轮结束后奇数队领先的分数，负数表示偶数队领先
+        return self.team1_score - self.team2_score
+
+# 每位选手在单场比赛中的汇总结果
+class PlayerMatchResult(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), index=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), unique=True)
+    total_score = db.Column(db.Integer, default=0)
+    first_places = db.Column(db.Integer, default=0)
+    player = db.relationship('Player', backref=db.backref('result', uselist=False, cascade="all, delete-orphan"))
+
+# 年度汇总（多年度 / 生涯报告使用）：往年计算一次后保存，fingerprint 记录计算时该年比赛数据的指纹，
+# 有比赛被补录、删除或新增成绩导致指纹变化时重新计算
+class YearRollup(db.Model):
+    year = db.Column(db.Integer, primary_key=True)
+    fingerprint = db.Column(db.String(100))
+    computed_at = db.Column(db.DateTime)
+    matches = db.Column(db.Integer, default=0)
+    finished_matches = db.Column(db.Integer, default=0)
+    rounds = db.Column(db.Integer, default=0)
+    participations = db.Column(db.Integer, default=0)
+
+# 选手年度汇总（只统计已结束的比赛，口径与年度报告一致）
+class PlayerYearRollup(db.Model):
+    year = db.Column(db.Integer, primary_key=True)
+    person_id = db.Column(db.Integer, db.ForeignKey('person.id'), primary_key=True)
+    matches = db.Column(db.Integer, default=0)
+    wins = db.Column(db.Integer, default=0)  # 平局算两队都胜
+    total_score = db.Column(db.Integer, default=0)
+    first_places = db.Column(db.Integer, default=0)
+    rank_count = db.Column(db.Integer, default=0)  # 参与的轮数
+    rank_sum = db.Column(db.Integer, default=0)
+    rank_square_sum = db.Column(db.Integer, default=0)  # 名次平方和，用于合并后计算方差
+    profit = db.Column(db.Integer, default=0)
+
+# 两人组合年度汇总（person1_id < person2_id）
+class PairYearRollup(db.Model):
+    year = db.Column(db.Integer, primary_key=True)
+    person1_id = db.Column(db.Integer, db.ForeignKey('person.id'), primary_key=True)
+    person2_id = db.Column(db.Integer, db.ForeignKey('person.id'), primary_key=True)
+    together = db.Column(db.Integer, default=0)
+    together_wins = db.Column(db.Integer, default=0)  # 同队获胜（平局不算）
+    against = db.Column(db.Integer, default=0)
+
+# 后台报告任务；完成后保存渲染好的页面，数据指纹不变时之后的访问直接返回
+class ReportJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    report_key = db.Column(db.String(50), index=True)  # 例如 annual:2025、multi_year:2023-2025
+    fingerprint = db.Column(db.String(2000))
+    status = db.Column(db.String(10), default='pending')  # pending / running / done / failed
+    html = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+# 选手等级分（Elo）：每场比赛结束时按两队平均等级分与比赛结果在线更新
+class PlayerRating(db.Model):
+    person_id = db.Column(db.Integer, db.ForeignKey('person.id'), primary_key=True)
+    rating = db.Column(db.Float)
+    matches = db.Column(db.Integer, default=0)  # 计入等级分的场次
+
+# 每场比赛每位选手的赛前 / 赛后等级分
+class RatingHistory(db.Model):
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), primary_key=True)
+    person_id = db.Column(db.Integer, db.ForeignKey('person.id'), primary_key=True, index=True)
+    team = db.Column(db.Integer)
+    rating_before = db.Column(db.Float)
+    rating_after = db.Column(db.Float)
+
+def match_outcome(team_scores):
+    # 根据两队总分返回 (获胜队伍, 收益积分差)
+    winning_team = 1 if team_scores[1] > team_scores[2] else 2 if team_scores[2] > team_scores[1] else None
+    profit_diff = min(abs(team_scores[1] - team_scores[2]), PROFIT_CAP)
+    return winning_team, profit_diff
+
+def level_advance(ranked_teams):
+    # ranked_teams 为本轮按名次排列的队伍序列，返回 (第一名队伍, 完全领先人数)。
+    # 完全领先人数即第一名所在队伍中名次高于对方最好名次的人数，两队都有成绩时才升级。
+    first_team = ranked_teams[0]
+    if len(set(ranked_teams)) < 2:
+        return first_team, 0
+    advance = 0
+    for team in ranked_teams:
+        if team != first_team:
+            break
+        advance += 1
+    return first_team, advance
+
+def advance_levels(levels, first_team, advance):
+    levels = dict(levels)
+    levels[first_team] = min(levels[first_team] + advance, len(LEVEL_CARDS) - 1)
+    return levels
+
+TIMELINE_FIELDS = ['round_number', 'leading_team', 'level_advance', 'team1_level', 'team2_level',
+                   'team1_points', 'team2_points', 'team1_score', 'team2_score']
+
+def next_round_state(previous, round_number, ranked_teams, ranked_points):
+    # 由上一轮结束后的逐轮记录（第一轮前为 None）推进一轮，返回本轮的 MatchRound 字段；
+    # ranked_teams / ranked_points 为本轮按名次排列的队伍与积分
+    levels = {1: previous['team1_level'], 2: previous['team2_level']} if previous else {1: 0, 2: 0}
+    first_team, advance = level_advance(ranked_teams)
+    levels = advance_levels(levels, first_team, advance)
+    points = {1: 0, 2: 0}
+    for team, value in zip(ranked_teams, ranked_points):
+        points[team] += value
+    return {'round_number': round_number, 'leading_team': first_team, 'level_advance': advance,
+            'team1_level': levels[1], 'team2_level': levels[2],
+            'team1_points': points[1], 'team2_points': points[2],
+            'team1_score': (previous['team1_score'] if previous else 0) + points[1],
+            'team2_score': (previous['team2_score'] if previous else 0) + points[2]}
+
+def replay_rounds(rounds):
+    # 从第一轮开始重放，rounds 为按轮次排列的 (轮次, 按名次排列的队伍序列, 按名次排列的积分)
+    history = []
+    for round_number, ranked_teams, ranked_points in rounds:
+        history.append(next_round_state(history[-1] if history else None, round_number, ranked_teams, ranked_points))
+    return history
+
+def init_match_result(match, players):
+    db.session.add(MatchResult(match_id=match.id, rounds=0, team1_score=0, team2_score=0,
+                               winning_team=None, profit_diff=0, finalized=False,
+                               team1_level=0, team2_level=0))
+    for player in players:
+        db.session.add(PlayerMatchResult(match_id=match.id, player=player, total_score=0, first_places=0))
+
+def submit_round(match, player_ids, expected_round=None):
+    # 在一个事务中录入一轮成绩：校验 → 推进轮次计数 → 批量插入成绩 → 批量更新汇总表。
+    # player_ids 按名次排列；返回错误信息，成功时返回 None。
+    result = match.result
+    teams = {player.id: player.team for player in match.players}
+    rules = {rule.rank: rule.points for rule in ScoreRule.query.filter_by(match_id=match.id).all()}
+
+    if match.status != 'ongoing':
+        return '错误：比赛已结束，不能再录入成绩！'
+    if len(player_ids) != match.player_count:
+        return '错误：本轮成绩不完整！'
+    if len(set(player_ids)) != len(player_ids):
+        return '错误：同一选手不能重复出现在成绩中！'
+    if any(player_id not in teams for player_id in player_ids):
+        return '错误：选手不属于本场比赛！'
+    if any(rank not in rules for rank in range(1, match.player_count + 1)):
+        return '错误：本场比赛的积分规则不完整！'
+
+    current_round = result.rounds
+    round_number = current_round + 1
+    if expected_round is not None and expected_round != round_number:
+        return f'错误：第 {expected_round} 轮成绩已提交，请勿重复提交！'
+
+    rows = [{'match_id': match.id, 'round_number': round_number, 'player_id': player_id,
+             'rank': rank, 'points': rules[rank]}
+            for rank, player_id in enumerate(player_ids, start=1)]
+    previous = {'team1_level': result.team1_level, 'team2_level': result.team2_level,
+                'team1_score': result.team1_score, 'team2_score': result.team2_score}
+    state = next_round_state(previous, round_number, [teams[player_id] for player_id in player_ids],
+                             [row['points'] for row in rows])
+    team_scores = {1: state['team1_score'], 2: state['team2_score']}
+    winning_team, profit_diff = match_outcome(team_scores)
+
+    try:
+        # 以轮次计数做乐观锁：只有计数仍为读取时的值、且比赛尚未结束才推进，并发提交（或结束比赛）的另一方会更新 0 行
+        result_table = MatchResult.__table__
+        advanced = db.session.execute(
+            result_table.update()
+            .where(result_table.c.match_id == match.id, result_table.c.rounds == current_round,
+                   result_table.c.finalized.is_(False))
+            .values(rounds=round_number,
+                    team1_score=team_scores[1],
+                    team2_score=team_scores[2],
+                    winning_team=winning_team,
+                    profit_diff=profit_diff,
+                    team1_level=state['team1_level'],
+                    team2_level=state['team2_level'])
+        ).rowcount
+        if advanced != 1:
+            db.session.rollback()
+            return f'错误：第 {round_number} 轮成绩已由其他记分员提交，请刷新后再录入！'
+        db.session.execute(RoundScore.__table__.insert(), rows)
+        db.session.execute(MatchRound.__table__.insert(), dict(state, match_id=match.id))
+        player_result_table = PlayerMatchResult.__table__
+        db.session.execute(
+            player_result_table.update()
+            .where(player_result_table.c.player_id == db.bindparam('b_player_id'))
+            .values(total_score=player_result_table.c.total_score + db.bindparam('b_points'),
+                    first_places=player_result_table.c.first_places + db.bindparam('b_first')),
+            [{'b_player_id': row['player_id'], 'b_points': row['points'], 'b_first': int(row['rank'] == 1)}
+             for row in rows]
+        )
+        db.session.commit()
+    except (IntegrityError, OperationalError):
+        # (match_id, round_number, rank) 唯一索引或数据库锁冲突：整轮回滚
+        db.session.rollback()
+        return f'错误：第 {round_number} 轮成绩提交冲突，请刷新后再录入！'
+    return None
+
+def end_match(match):
+    # 结束比赛并计入等级分。与 submit_round 使用同一把乐观锁：只有比赛未结束、且轮次仍为读取时的值才定稿，
+    # 同时提交的成绩或重复的结束请求只有一方成功；返回错误信息，成功时返回 None
+    result = match.result
+    winning_team, profit_diff = match_outcome(result.team_scores)
+    result_table = MatchResult.__table__
+    try:
+        ended = db.session.execute(
+            result_table.update()
+            .where(result_table.c.match_id == match.id, result_table.c.rounds == result.rounds,
+                   result_table.c.finalized.is_(False))
+            .values(finalized=True, winning_team=winning_team, profit_diff=profit_diff)
+        ).rowcount
+        if ended != 1:
+            db.session.rollback()
+            return '错误：比赛已结束或刚录入了新成绩，请刷新后再操作！'
+        db.session.expire(result)  # 之后读取定稿后的汇总
+        match.status = 'finished'
+        update_ratings(match)
+        db.session.commit()
+    except (IntegrityError, OperationalError):
+        db.session.rollback()
+        return '错误：结束比赛时发生冲突，请刷新后再操作！'
+    return None
+
+def compute_match_results(match_ids=None):
+    # 从原始成绩重新计算汇总：{match_id: {'rounds', 'team_scores', 'finalized', 'levels', 'history'（逐轮记录）,
+    #                                       'players': {player_id: (总分, 第一名次数)}}}
+    match_query = db.session.query(
+        Match.id,
+        Match.status,
+        db.func.count(db.distinct(RoundScore.round_number))
+    ).outerjoin(RoundScore, RoundScore.match_id == Match.id).group_by(Match.id)
+    player_query = db.session.query(
+        Player.id,
+        Player.match_id,
+        Player.team,
+        db.func.coalesce(db.func.sum(RoundScore.points), 0),
+        db.func.coalesce(db.func.sum(db.case((RoundScore.rank == 1, 1), else_=0)), 0)
+    ).outerjoin(RoundScore, db.and_(RoundScore.player_id == Player.id,
+                                    RoundScore.match_id == Player.match_id)).group_by(Player.id)
+    rank_query = db.session.query(
+        RoundScore.match_id,
+        RoundScore.round_number,
+        Player.team,
+        RoundScore.points
+    ).join(Player, Player.id == RoundScore.player_id) \
+     .order_by(RoundScore.match_id, RoundScore.round_number, RoundScore.rank)
+    if match_ids is not None:
+        match_query = match_query.filter(Match.id.in_(match_ids))
+        player_query = player_query.filter(Player.match_id.in_(match_ids))
+        rank_query = rank_query.filter(RoundScore.match_id.in_(match_ids))
+
+    results = {}
+    for match_id, status, rounds in match_query.all():
+        results[match_id] = {'rounds': rounds, 'team_scores': {1: 0, 2: 0},
+                             'finalized': status == 'finished', 'players': {},
+                             'levels': {1: 0, 2: 0}, 'history': []}
+    for player_id, match_id, team, total, first_places in player_query.all():
+        if match_id not in results:
+            continue
+        results[match_id]['players'][player_id] = (total, first_places)
+        results[match_id]['team_scores'][team] += total
+    for match_id, match_rows in groupby(rank_query.all(), key=lambda row: row[0]):
+        if match_id not in results:
+            continue
+        rounds = []
+        for round_number, round_rows in groupby(match_rows, key=lambda row: row[1]):
+            round_rows = list(round_rows)
+            rounds.append((round_number, [row[2] for row in round_rows], [row[3] for row in round_rows]))
+        history = replay_rounds(rounds)
+        results[match_id]['history'] = history
+        results[match_id]['levels'] = {1: history[-1]['team1_level'], 2: history[-1]['team2_level']}
+    return results
+
+def rebuild_match_results(match_ids=None):
+    results = compute_match_results(match_ids)
+    if match_ids is None:
+        MatchResult.query.delete()
+        PlayerMatchResult.query.delete()
+        MatchRound.query.delete()
+    else:
+        MatchResult.query.filter(MatchResult.match_id.in_(match_ids)).delete()
+        PlayerMatchResult.query.filter(PlayerMatchResult.match_id.in_(match_ids)).delete()
+        MatchRound.query.filter(MatchRound.match_id.in_(match_ids)).delete()
+    for match_id, expected in results.items():
+        winning_team, profit_diff = match_outcome(expected['team_scores'])
+        db.session.add(MatchResult(match_id=match_id,
+                                   rounds=expected['rounds'],
+                                   team1_score=expected['team_scores'][1],
+                                   team2_score=expected['team_scores'][2],
+                                   winning_team=winning_team,
+                                   profit_diff=profit_diff,
+                                   finalized=expected['finalized'],
+                                   team1_level=expected['levels'][1],
+                                   team2_level=expected['levels'][2]))
+        for state in expected['history']:
+            db.session.add(MatchRound(match_id=match_id, **state))
+        for player_id, (total, first_places) in expected['players'].items():
+            db.session.add(PlayerMatchResult(match_id=match_id, player_id=player_id,
+                                             total_score=total, first_places=first_places))
+    return len(results)
+
+def check_match_results():
+    # 校验汇总表与原始成绩是否一致，返回不一致的描述列表
+    problems = []
+    stored = {r.match_id: r for r in MatchResult.query.all()}
+    stored_players = {pr.player_id: pr for pr in PlayerMatchResult.query.all()}
+    stored_history = defaultdict(list)
+    for r in MatchRound.query.order_by(MatchRound.match_id, MatchRound.round_number).all():
+        stored_history[r.match_id].append({field: getattr(r, field) for field in TIMELINE_FIELDS})
+    for match_id, expected in compute_match_results().items():
+        result = stored.get(match_id)
+        if result is None:
+            problems.append(f'比赛 {match_id}: 缺少汇总记录')
+            continue
+        winning_team, profit_diff = match_outcome(expected['team_scores'])
+        actual = (result.rounds, result.team_scores, result.winning_team, result.profit_diff, result.finalized)
+        wanted = (expected['rounds'], expected['team_scores'], winning_team, profit_diff, expected['finalized'])
+        if actual != wanted:
+            problems.append(f'比赛 {match_id}: 汇总 {actual} 与原始成绩 {wanted} 不一致')
+        # 级牌状态与逐轮重放的结果对比
+        if result.team_levels != expected['levels']:
+            problems.append(f'比赛 {match_id}: 级牌 {result.team_levels} 与逐轮重放结果 {expected["levels"]} 不一致')
+        if stored_history[match_id] != expected['history']:
+            problems.append(f'比赛 {match_id}: 逐轮记录与逐轮重放结果不一致')
+        for player_id, (total, first_places) in expected['players'].items():
+            player_result = stored_players.get(player_id)
+            actual = (player_result.total_score, player_result.first_places) if player_result else None
+            if actual != (total, first_places):
+                problems.append(f'比赛 {match_id} 选手 {player_id}: 汇总 {actual} 与原始成绩 {(total, first_places)} 不一致')
+    return problems
+
+REPORT_YEARS = range(datetime.MINYEAR, datetime.MAXYEAR)  # year_range 需要下一年的 1 月 1 日，可统计的年份为 1 ~ 9998
+
+def year_range(year):
+    # 以时间区间代替 extract('year', ...)，使 Match.time 上的索引可以被使用；year 须在 REPORT_YEARS 之内
+    return db.and_(Match.time >= datetime.datetime(year, 1, 1),
+                   Match.time < datetime.datetime(year + 1, 1, 1))
+
+# === 统计数据快照 ===
+# 统计代码只读取少数几列，按批读取元组装入 array 列（每个值 1~8 字节），不创建 ORM 对象和身份映射
+SNAPSHOT_BATCH_SIZE = 5000
+
+class MatchRecord:
+    # 快照中一场比赛的轻量记录，供模板显示
+    __slots__ = ('id', 'player_count', 'time', 'location', 'finished')
+
+    def __init__(self, id, player_count, time, location, finished):
+        self.id = id
+        self.player_count = player_count
+        self.time = time
+        self.location = location
+        self.finished = finished
+
+class PlayerRecord:
+    __slots__ = ('id', 'match_id', 'person_id', 'name', 'team')
+
+    def __init__(self, id, match_id, person_id, name, team):
+        self.id = id
+        self.match_id = match_id
+        self.person_id = person_id
+        self.name = name
+        self.team = team
+
+def snapshot_match_rows(*criteria):
+    finished = db.case((Match.status == 'finished', 1), else_=0)
+    return db.session.query(Match.id, Match.player_count, finished, Match.time, Match.location) \
+        .filter(*criteria) \
+        .order_by(Match.id)
+
+def snapshot_player_rows(*criteria):
+    return db.session.query(Player.id, Player.match_id, Player.person_id, Player.team, Player.name) \
+        .join(Match, Match.id == Player.match_id) \
+        .filter(*criteria) \
+        .order_by(Player.match_id, Player.id)
+
+def snapshot_score_rows(*criteria):
+    # 成绩行数最多，不在 SQL 中连接 Player 和排序（两者占查询耗时的三分之一），读入后由 AnalyticsSnapshot 过滤、排序
+    return db.session.query(
+        RoundScore.match_id,
+        RoundScore.round_number,
+        RoundScore.player_id,
+        RoundScore.rank,
+        RoundScore.points
+    ).join(Match, Match.id == RoundScore.match_id) \
+     .filter(*criteria)
+
+def snapshot_round_rows(*criteria):
+    return db.session.query(
+        MatchRound.match_id,
+        MatchRound.round_number,
+        MatchRound.team1_points,
+        MatchRound.team2_points,
+        MatchRound.team1_score - MatchRound.team2_score
+    ).join(Match, Match.id == MatchRound.match_id) \
+     .filter(*criteria) \
+     .order_by(MatchRound.match_id, MatchRound.round_number)
+
+def fetch_columns(query, typecodes):
+    # 绕过 ORM 直接在 Core 层按批读取元组，逐列追加到 array 后转为共享内存的 NumPy 数组；
+    # typecode 为 None 的列（时间、文本）保存为列表
+    import numpy as np
+    from array import array
+    columns = [array(typecode) if typecode else [] for typecode in typecodes]
+    result = db.session.connection().execute(query.statement.execution_options(yield_per=SNAPSHOT_BATCH_SIZE))
+    for batch in result.partitions():
+        for column, values in zip(columns, zip(*batch)):
+            column.extend(values)
+    return [np.asarray(column) if typecode else column for column, typecode in zip(columns, typecodes)]
+
+class AnalyticsSnapshot:
+    # 满足 criteria 的全部比赛的列式快照（NumPy 数组）。比赛、选手、成绩、逐轮记录各为一组等长数组，
+    # 选手与成绩按比赛排序，第 m 场比赛的选手为 player_offsets[m]:player_offsets[m + 1]，成绩与逐轮记录同理。
+    # *_match 列保存比赛序号，score_player 保存选手序号（而不是 id），可以直接用于数组下标。
+    __slots__ = ('match_ids', 'player_counts', 'finished', 'match_times', 'locations',
+                 'player_ids', 'player_match', 'player_persons', 'player_teams', 'player_names', 'player_offsets',
+                 'score_match', 'score_rounds', 'score_player', 'score_ranks', 'score_points', 'score_offsets',
+                 'round_match', 'round_numbers', 'round_team1_points', 'round_team2_points', 'round_leads',
+                 'round_offsets')
+
+    def __init__(self, *criteria):
+        import numpy as np
+        self.match_ids, self.player_counts, self.finished, self.match_times, self.locations = \
+            fetch_columns(snapshot_match_rows(*criteria), ['q', 'h', 'b', None, None])
+        self.player_ids, player_match_ids, self.player_persons, self.player_teams, names = \
+            fetch_columns(snapshot_player_rows(*criteria), ['q', 'q', 'q', 'b', None])
+        score_columns = fetch_columns(snapshot_score_rows(*criteria), ['q', 'i', 'q', 'h', 'i'])
+        round_match_ids, self.round_numbers, self.round_team1_points, self.round_team2_points, self.round_leads = \
+            fetch_columns(snapshot_round_rows(*criteria), ['q', 'i', 'i', 'i', 'i'])
+        interned = {}
+        self.player_names = [interned.setdefault(name, name) for name in names]  # 同名选手共用一个字符串
+        self.finished = self.finished.astype(bool)
+
+        # 比赛 id 与选手 id 换成序号
+        self.player_match = np.searchsorted(self.match_ids, player_match_ids).astype(np.int32)
+        self.round_match = np.searchsorted(self.match_ids, round_match_ids).astype(np.int32)
+
+        # 只保留属于本场选手的成绩，按 (比赛, 轮次, 名次, 选手) 排序
+        score_match_ids, score_rounds, score_player_ids, score_ranks, score_points = score_columns
+        score_match = np.searchsorted(self.match_ids, score_match_ids).astype(np.int32)
+        score_player = np.zeros(len(score_match), dtype=np.int32)
+        valid = np.zeros(len(score_match), dtype=bool)
+        if len(self.player_ids):
+            by_id = np.argsort(self.player_ids)
+            position = np.searchsorted(self.player_ids, score_player_ids, sorter=by_id)
+            score_player = by_id[np.minimum(position, len(by_id) - 1)].astype(np.int32)
+            valid = (self.player_ids[score_player] == score_player_ids) & (self.player_match[score_player] == score_match)
+        order = np.lexsort((score_player_ids, score_ranks, score_rounds, score_match))
+        order = order[valid[order]]
+        self.score_match, self.score_rounds, self.score_player, self.score_ranks, self.score_points = \
+            (column[order] for column in (score_match, score_rounds, score_player, score_ranks, score_points))
+
+        boundaries = np.arange(len(self.match_ids) + 1)
+        self.player_offsets = np.searchsorted(self.player_match, boundaries)
+        self.score_offsets = np.searchsorted(self.score_match, boundaries)
+        self.round_offsets = np.searchsorted(self.round_match, boundaries)
+
+    def match(self, m):
+        return MatchRecord(int(self.match_ids[m]), int(self.player_counts[m]), self.match_times[m],
+                           self.locations[m], bool(self.finished[m]))
+
+    def players(self, m):
+        return [PlayerRecord(int(self.player_ids[i]), int(self.match_ids[m]), int(self.player_persons[i]),
+                             self.player_names[i], int(self.player_teams[i]))
+                for i in range(self.player_offsets[m], self.player_offsets[m + 1])]
+
+def year_snapshot(year):
+    return AnalyticsSnapshot(year_range(year))
+
+def get_or_create_person(name, persons=None):
+    # 按规范化后的姓名查找选手身份，不存在则创建；persons 为可选的 {姓名: Person} 缓存
+    name = name.strip()
+    person = persons.get(name) if persons is not None else Person.query.filter_by(name=name).first()
+    if person is None:
+        # 另一个请求可能同时创建了同名选手：插入放在保存点中，违反唯一约束时只回滚这一条插入，再读取对方创建的记录
+        try:
+            with db.session.begin_nested():
+                person = Person(name=name)
+                db.session.add(person)
+        except IntegrityError:
+            person = Person.query.filter_by(name=name).one()
+    if persons is not None:
+        persons[name] = person
+    return person
+
+def ensure_columns():
+    # 旧数据库的表缺少模型中新增的列时补上（SQLite 只支持 ADD COLUMN，已有数据不受影响），返回补上的 (表名, 列名)
+    engine = db.session.get_bind()
+    inspector = db.inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}'
+                if column.default is not None and column.default.is_scalar:
+                    ddl += f' DEFAULT {int(column.default.arg) if isinstance(column.default.arg, bool) else column.default.arg!r}'
+                for foreign_key in column.foreign_keys:
+                    ddl += f' REFERENCES {foreign_key.column.table.name}({foreign_key.column.name})'
+                conn.exec_driver_sql(ddl)
+                added.append((table.name, column.name))
+    return added
+
+def migrate_persons():
+    # 旧数据库中尚未关联选手身份的 Player 按姓名合并为 Person
+    unlinked = Player.query.filter(Player.person_id.is_(None)).order_by(Player.id).all()
+    if not unlinked:
+        return 0
+    persons = {person.name: person for person in Person.query.all()}
+    for player in unlinked:
+        person = get_or_create_person(player.name or '', persons)
+        player.person_id = person.id
+        player.name = person.name
+    db.session.commit()
+    return len(unlinked)
+
+OBSOLETE_INDEXES = ['ix_round_score_match_round_rank',  # 已被唯一索引 uq_round_score_match_round_rank 取代
+                    'ix_match_time']  # 已被 ix_match_time_id 取代
+
+def ensure_indexes():
+    # 旧数据库中表已存在时 create_all 不会补建索引，这里逐个检查并补齐（不影响已有数据）
+    engine = db.session.get_bind()
+    failed = []
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except IntegrityError:
+                failed.append(index.name)
+                app.logger.warning('无法创建唯一索引 %s：数据库中已有重复记录，请先清理', index.name)
+    if not failed:
+        with engine.begin() as conn:
+            for name in OBSOLETE_INDEXES:
+                conn.exec_driver_sql(f'DROP INDEX IF EXISTS {name}')
+
+def ensure_autoincrement():
+    # 旧数据库的 match 表没有 AUTOINCREMENT（删除最新的比赛后 id 会被复用），按 SQLite 推荐的步骤重建：
+    # 建新表 → 复制数据（保留 id）→ 删除旧表 → 改名。旧表上的索引随之删除，由之后的 ensure_indexes 补建
+    engine = db.session.get_bind()
+    if engine.dialect.name != 'sqlite':
+        return False
+    table = Match.__table__
+    with engine.begin() as conn:
+        sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                   (table.name,)).scalar()
+        if sql is None or 'AUTOINCREMENT' in sql.upper():
+            return False
+        rebuilt = table.to_metadata(db.MetaData(), name=f'{table.name}_rebuild')
+        conn.execute(db.schema.CreateTable(rebuilt))
+        preparer = engine.dialect.identifier_preparer
+        columns = ', '.join(preparer.quote(column.name) for column in table.columns)
+        conn.exec_driver_sql(f'INSERT INTO {preparer.format_table(rebuilt)} ({columns}) '
+                             f'SELECT {columns} FROM {preparer.format_table(table)}')
+        conn.exec_driver_sql(f'DROP TABLE {preparer.format_table(table)}')
+        conn.exec_driver_sql(f'ALTER TABLE {preparer.format_table(rebuilt)} RENAME TO {preparer.format_table(table)}')
+    return True
+
+def allocated_match_id():
+    # 已分配过的最大比赛 id：删除最新的比赛后 AUTOINCREMENT 计数（sqlite_sequence）仍大于现有最大 id，新 id 须排在它之后
+    allocated = db.session.query(db.func.coalesce(db.func.max(Match.id), 0)).scalar()
+    if db.session.get_bind().dialect.name == 'sqlite':
+        seq = db.session.execute(db.text('SELECT seq FROM sqlite_sequence WHERE name = :name'),
+                                 {'name': Match.__tablename__}).scalar()
+        allocated = max(allocated, seq or 0)
+    return allocated
+
+def hot_queries():
+    # 各页面的高频查询，用于对比索引前后的查询计划
+    latest = Match.query.order_by(Match.id.desc()).first()
+    match_id = latest.id if latest else 0
+    year = latest.time.year if latest and latest.time else datetime.datetime.now().year
+    first_player = Player.query.first()
+    person_id = first_player.person_id if first_player else 0
+    return [
+        ('比赛详情：本场成绩', RoundScore.query.filter_by(match_id=match_id).order_by(RoundScore.id)),
+        ('比赛详情：本场选手', Player.query.filter_by(match_id=match_id)),
+        ('录入成绩：积分规则', ScoreRule.query.filter_by(match_id=match_id)),
+        ('录入成绩：已录入成绩数', db.session.query(db.func.count(RoundScore.id)).filter(RoundScore.match_id == match_id)),
+        ('选手历史成绩', db.session.query(RoundScore).join(Player, Player.id == RoundScore.player_id).filter(Player.person_id == person_id)),
+        ('年度比赛：extract 过滤', Match.query.filter(db.extract('year', Match.time) == year)),
+        ('年度比赛：时间区间过滤', Match.query.filter(year_range(year))),
+        ('年度报告：成绩快照', snapshot_score_rows(year_range(year))),
+    ]
+
+@app.cli.command('query-plans')
+@click.option('--repeat', default=20, show_default=True, help='每条查询重复执行的次数')
+def query_plans_command(repeat):
+    # 将当前数据库复制到内存中，分别在去掉索引和建立索引后输出查询计划与耗时
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
+
+    memory = sqlite3.connect(':memory:', check_same_thread=False)
+    source = db.session.get_bind().raw_connection()
+    try:
+        source.driver_connection.backup(memory)
+    finally:
+        source.close()
+    memory_engine = create_engine('sqlite://', creator=lambda: memory, poolclass=StaticPool)
+
+    queries = [(name, str(query.statement.compile(dialect=db.session.get_bind().dialect, compile_kwargs={'literal_binds': True})))
+               for name, query in hot_queries()]
+    indexes = [index for table in db.metadata.sorted_tables for index in table.indexes]
+
+    def report(label):
+        click.echo(f'=== {label} ===')
+        for name, sql in queries:
+            plan = [row[-1] for row in memory.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()]
+            start = time.perf_counter()
+            for _ in range(repeat):
+                memory.execute(sql).fetchall()
+            elapsed = (time.perf_counter() - start) / repeat * 1000
+            click.echo(f'{name}: {elapsed:.3f} ms')
+            for detail in plan:
+                click.echo(f'    {detail}')
+
+    for index in indexes:
+        memory.execute(f'DROP INDEX IF EXISTS {index.name}')
+    report('无索引')
+    for index in indexes:
+        index.create(bind=memory_engine)
+    memory.execute('ANALYZE')
+    report('有索引')
+
+@app.cli.command('rebuild-results')
+@click.option('--check', is_flag=True, help='只校验汇总表与原始成绩是否一致，不写入')
+def rebuild_results_command(check):
+    if check:
+        problems = check_match_results()
+        for problem in problems:
+            click.echo(problem)
+        click.echo(f'发现 {len(problems)} 处不一致')
+        if problems:
+            raise SystemExit(1)
+        return
+    count = rebuild_match_results()
+    db.session.commit()
+    click.echo(f'已重建 {count} 场比赛的汇总结果')
+
+# === 等级分 ===
+def rate_match(ratings, players, winning_team):
+    # 两队各以队员平均等级分作为队伍等级分计算期望胜率，胜 / 平 / 负记 1 / 0.5 / 0，
+    # 同队选手的等级分变化相同，两队变化之和为零。ratings 为 {person_id: 等级分}（原地更新），
+    # players 为 (person_id, 队伍) 列表；返回 [(person_id, 队伍, 赛前, 赛后)]，有一队没有选手时不计算
+    teams = {1: [], 2: []}
+    for person_id, team in players:
+        teams[team].append(person_id)
+    if not teams[1] or not teams[2]:
+        return []
+    initial = app.config['RATING_INITIAL']
+    strength = {team: sum(ratings.get(person_id, initial) for person_id in members) / len(members)
+                for team, members in teams.items()}
+    expected = 1 / (1 + 10 ** ((strength[2] - strength[1]) / 400))
+    actual = 0.5 if not winning_team else 1 if winning_team == 1 else 0
+    change = {1: app.config['RATING_K_FACTOR'] * (actual - expected)}
+    change[2] = -change[1]
+    updates = []
+    for person_id, team in players:
+        before = ratings.get(person_id, initial)
+        ratings[person_id] = before + change[team]
+        updates.append((person_id, team, before, ratings[person_id]))
+    return updates
+
+def update_ratings(match):
+    # 结束比赛时调用（与结束比赛在同一事务中提交）；本场已计入时不重复计算。
+    # 等级分与计算顺序有关：按时间排在已计入的比赛之前（补录的旧比赛），增量计算会与 rebuild_ratings 的结果不同，改为整体重放
+    if RatingHistory.query.filter_by(match_id=match.id).first() is not None:
+        return
+    later = RatingHistory.query.join(Match, Match.id == RatingHistory.match_id)
+    if match.time is None:
+        later = later.filter(Match.time.is_(None), Match.id > match.id)
+    else:
+        later = later.filter(db.or_(Match.time.is_(None), Match.time > match.time,
+                                    db.and_(Match.time == match.time, Match.id > match.id)))
+    if later.first() is not None:
+        rebuild_ratings()
+        return
+    players = [(player.person_id, player.team) for player in match.players]
+    stored = {rating.person_id: rating for rating in
+              PlayerRating.query.filter(PlayerRating.person_id.in_({person_id for person_id, _ in players})).all()}
+    ratings = {person_id: rating.rating for person_id, rating in stored.items()}
+    for person_id, team, before, after in rate_match(ratings, players, match.result.winning_team):
+        if person_id not in stored:
+            stored[person_id] = PlayerRating(person_id=person_id, matches=0)
+            db.session.add(stored[person_id])
+        stored[person_id].rating = after
+        stored[person_id].matches += 1
+        db.session.add(RatingHistory(match_id=match.id, person_id=person_id, team=team,
+                                     rating_before=before, rating_after=after))
+
+def rebuild_ratings():
+    # 按比赛时间顺序重放全部已结束比赛（修改计算规则或导入历史数据后使用），返回计入的场次
+    rows = db.session.query(Match.id, MatchResult.winning_team, Player.person_id, Player.team) \
+        .join(MatchResult, MatchResult.match_id == Match.id) \
+        .join(Player, Player.match_id == Match.id) \
+        .filter(MatchResult.finalized.is_(True)) \
+        .order_by(Match.time.is_(None), Match.time, Match.id, Player.id)
+    ratings = {}
+    matches = Counter()
+    history = []
+    rated = 0
+    for match_id, match_rows in groupby(rows.yield_per(SNAPSHOT_BATCH_SIZE), key=lambda row: row[0]):
+        match_rows = list(match_rows)
+        updates = rate_match(ratings, [(row[2], row[3]) for row in match_rows], match_rows[0][1])
+        for person_id, team, before, after in updates:
+            matches[person_id] += 1
+            history.append({'match_id': match_id, 'person_id': person_id, 'team': team,
+                            'rating_before': before, 'rating_after': after})
+        rated += bool(updates)
+
+    RatingHistory.query.delete()
+    PlayerRating.query.delete()
+    if ratings:
+        db.session.execute(PlayerRating.__table__.insert(),
+                           [{'person_id': person_id, 'rating': rating, 'matches': matches[person_id]}
+                            for person_id, rating in ratings.items()])
+    if history:
+        db.session.execute(RatingHistory.__table__.insert(), history)
+    return rated
+
+def rating_leaderboard():
+    # 直接读取等级分表，与比赛场数无关
+    rows = db.session.query(Person.name, PlayerRating.rating, PlayerRating.matches) \
+        .join(PlayerRating, PlayerRating.person_id == Person.id) \
+        .order_by(PlayerRating.rating.desc(), Person.id) \
+        .all()
+    return [(i + 1, name, round(rating), matches) for i, (name, rating, matches) in enumerate(rows)]
+
+@app.cli.command('rebuild-ratings')
+def rebuild_ratings_command():
+    start = time.perf_counter()
+    count = rebuild_ratings()
+    db.session.commit()
+    click.echo(f'已按时间顺序重放 {count} 场比赛的等级分（{time.perf_counter() - start:.1f} 秒）')
+
+# === 数据导出 / 导入 ===
+# 每张原始数据表导出为一个 CSV 文件（汇总表可由原始成绩重建，不导出），按主键分块流式读写，内存占用与数据量无关
+EXPORT_TABLES = [('persons', Person), ('matches', Match), ('players', Player),
+                 ('score_rules', ScoreRule), ('round_scores', RoundScore)]
+CSV_CHUNK_SIZE = 5000
+
+def open_export_file(directory, name, mode, compress=None):
+    # 导入时自动识别 .csv 与 .csv.gz
+    path = os.path.join(directory, f'{name}.csv')
+    if compress or (compress is None and not os.path.exists(path) and os.path.exists(path + '.gz')):
+        return gzip.open(path + '.gz', mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+def export_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+def import_csv_value(column, value):
+    if value == '':
+        return None
+    python_type = column.type.python_type
+    if python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(value)
+    return python_type(value)
+
+@app.cli.command('export-data')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--gzip', 'compress', is_flag=True, help='导出为 .csv.gz')
+def export_data_command(directory, compress):
+    os.makedirs(directory, exist_ok=True)
+    for name, model in EXPORT_TABLES:
+        table = model.__table__
+        columns = [column.name for column in table.columns]
+        count = 0
+        with open_export_file(directory, name, 'w', compress) as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            rows = db.session.execute(table.select().order_by(table.c.id).execution_options(yield_per=CSV_CHUNK_SIZE))
+            for chunk in rows.partitions():
+                writer.writerows([export_csv_value(value) for value in row] for row in chunk)
+                count += len(chunk)
+        click.echo(f'{name}: {count} 行')
+
+def read_export_file(directory, name, table):
+    # 逐块读取 CSV，每块为按模型列转换好类型的字典列表
+    try:
+        f = open_export_file(directory, name, 'r')
+    except FileNotFoundError:
+        raise click.ClickException(f'{directory} 中缺少 {name}.csv')
+    with f:
+        reader = csv.DictReader(f)
+        expected = [column.name for column in table.columns]
+        if sorted(reader.fieldnames or []) != sorted(expected):
+            raise click.ClickException(f'{name}.csv 的列 {reader.fieldnames} 与数据表 {expected} 不一致')
+        chunk = []
+        for record in reader:
+            chunk.append({column.name: import_csv_value(column, record[column.name]) for column in table.columns})
+            if len(chunk) >= CSV_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+@app.cli.command('import-data')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+def import_data_command(directory):
+    # 在一个事务中批量写入导出的数据：选手身份按姓名合并，其余记录的 id 整体平移到现有数据之后，
+    # 因此既可以导入空数据库（id 保持不变），也可以合并到已有数据中；导入后重建这些比赛的汇总结果
+    offsets = {model: db.session.query(db.func.coalesce(db.func.max(model.id), 0)).scalar()
+               for model in (Player, ScoreRule, RoundScore)}
+    offsets[Match] = allocated_match_id()  # 比赛 id 不复用，已删除比赛的 id 也要跳过
+    persons = dict(db.session.query(Person.name, Person.id).all())
+    next_person_id = max(persons.values(), default=0) + 1
+    person_ids = {}  # 导出文件中的 person.id -> 本库 person.id
+    match_ids = []
+    try:
+        for name, model in EXPORT_TABLES:
+            table = model.__table__
+            count = 0
+            for chunk in read_export_file(directory, name, table):
+                if model is Person:
+                    new_rows = []
+                    for row in chunk:
+                        person_name = (row['name'] or '').strip()  # 空姓名导出为空字符串，读入时为 None
+                        if person_name not in persons:
+                            persons[person_name] = next_person_id
+                            new_rows.append({'id': next_person_id, 'name': person_name})
+                            next_person_id += 1
+                        person_ids[row['id']] = persons[person_name]
+                    chunk = new_rows
+                else:
+                    for row in chunk:
+                        row['id'] += offsets[model]
+                        if 'match_id' in row:
+                            row['match_id'] += offsets[Match]
+                        if 'player_id' in row:
+                            row['player_id'] += offsets[Player]
+                        if 'person_id' in row:
+                            row['person_id'] = person_ids.get(row['person_id'])
+                    if model is Match:
+                        match_ids.extend(row['id'] for row in chunk)
+                if chunk:
+                    db.session.execute(table.insert(), chunk)
+                count += len(chunk)
+            click.echo(f'{name}: {count} 行')
+        for start in range(0, len(match_ids), 500):
+            rebuild_match_results(match_ids[start:start + 500])
+        rebuild_ratings()  # 导入的比赛可能早于已有比赛，按时间顺序整体重放
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    # 年度报告缓存在运行中的服务进程里，这个命令行进程清除不到
+    click.echo(f'已导入 {len(match_ids)} 场比赛；正在运行的服务需要重启（或开启 REPORT_CACHE_VALIDATE）才会显示导入年份的新报告')
+
+def init_database():
+    # 建表并升级旧数据库：应用启动时对默认数据库执行，各俱乐部的数据库第一次使用时执行
+    db.metadata.create_all(bind=db.session.get_bind())
+    added_columns = ensure_columns()
+    migrate_persons()
+    ensure_autoincrement()
+    ensure_indexes()
+    # 汇总表新增的列在已有记录中只有默认值，全部重建
+    if any(table in (MatchResult.__tablename__, MatchRound.__tablename__, PlayerMatchResult.__tablename__)
+           for table, _ in added_columns):
+        rebuild_match_results()
+        db.session.commit()
+    # 旧数据库中尚无汇总记录、或逐轮记录不完整的比赛自动补齐
+    missing = [match_id for (match_id,) in db.session.query(Match.id).outerjoin(MatchResult).filter(MatchResult.match_id.is_(None)).all()]
+    missing += [match_id for (match_id,) in db.session.query(MatchResult.match_id)
+                .outerjoin(MatchRound, MatchRound.match_id == MatchResult.match_id)
+                .group_by(MatchResult.match_id, MatchResult.rounds)
+                .having(db.func.count(MatchRound.round_number) != MatchResult.rounds).all()]
+    if missing:
+        rebuild_match_results(missing)
+        db.session.commit()
+    # 旧数据库第一次启动时根据已结束的比赛计算等级分
+    if RatingHistory.query.first() is None and MatchResult.query.filter(MatchResult.finalized.is_(True)).first() is not None:
+        rebuild_ratings()
+        db.session.commit()
 
 with app.app_context():
-    db.create_all()
+    init_database()
 
-@app.route('/')
-def index():
-    matches = Match.query.all()
-
-    # 按照时间先后排序（处理 NULL 值）
-    matches = sorted(matches, key=lambda m: m.time if m.time else datetime.datetime.min, reverse=True)
-
-    # 计算选手总分排行榜
-    all_players = Player.query.all()
-    player_scores = {}
-    for player in all_players:
-        name = player.name
-        if name not in player_scores:
-            player_scores[name] = 0
-        scores = RoundScore.query.filter_by(player_id=player.id).all()
-        player_scores[name] += sum(score.points for score in scores if score.points is not None)
-    sorted_score_rankings = sorted(player_scores.items(), key=lambda x: x[1], reverse=True)
-    score_rankings_with_index = [(i + 1, name, score) for i, (name, score) in enumerate(sorted_score_rankings)]
-
-    # 计算选手胜率排行榜
-    player_stats = {}  # {name: {'matches': 场次, 'wins': 胜场}}
-    for match in matches:
-        if match.status == 'finished':  # 只统计已结束的比赛
-            players = Player.query.filter_by(match_id=match.id).all()
-            total_scores = {}
-            for player in players:
-                player_scores = RoundScore.query.filter_by(match_id=match.id, player_id=player.id).all()
-                total_scores[player.id] = sum(score.points for score in player_scores if score.points is not None)
-
-            team_scores = {1: 0, 2: 0}
-            for player in players:
-                team_scores[player.team] += total_scores.get(player.id, 0)
-
-            winning_team = 1 if team_scores[1] > team_scores[2] else 2 if team_scores[2] > team_scores[1] else None
-
-            for player in players:
-                name = player.name
-                if name not in player_stats:
-                    player_stats[name] = {'matches': 0, 'wins': 0}
-                player_stats[name]['matches'] += 1
-                if winning_team and player.team == winning_team:
-                    player_stats[name]['wins'] += 1
-                # 如果平局，算两边都胜利
-                if not winning_team:
-                    player_stats[name]['wins'] += 1
+def leaderboard_totals():
+    # 排行榜的可累加部分：[(姓名, 总积分)] 与 [(姓名, 场次, 胜场)]，分别按选手首次出现的顺序和最近比赛的顺序排列，
+    # 多个俱乐部的结果可以按姓名相加（merge_leaderboard_totals）后再排名
+    # 选手总分：基于比赛汇总表按选手身份聚合，按选手首次出现的顺序保持并列名次的先后
+    score_rows = db.session.query(
+        Person.name,
+        db.func.coalesce(db.func.sum(PlayerMatchResult.total_score), 0)
+    ).join(Player, Player.person_id == Person.id) \
+     .outerjoin(PlayerMatchResult, PlayerMatchResult.player_id == Player.id) \
+     .group_by(Person.id) \
+     .order_by(db.func.min(Player.id)) \
+     .all()
+
+    # 选手胜率：已定稿比赛的获胜队伍直接取自汇总表（按比赛时间倒序）
+    player_rows = db.session.query(
+        Player.person_id,
+        Player.name,
+        Player.team,
+        MatchResult.winning_team
+    ).join(MatchResult, MatchResult.match_id == Player.match_id) \
+     .join(Match, Match.id == Player.match_id) \
+     .filter(MatchResult.finalized.is_(True)) \
+     .order_by(Match.time.is_(None), Match.time.desc(), Match.id, Player.id) \
+     .all()
+
+    player_stats = {}  # {person_id: {'name': 姓名, 'matches': 场次, 'wins': 胜场}}
+    for person_id, name, team, winning_team in player_rows:
+        if person_id not in player_stats:
+            player_stats[person_id] = {'name': name, 'matches': 0, 'wins': 0}
+        player_stats[person_id]['matches'] += 1
+        # 如果平局，算两边都胜利
+        if not winning_team or team == winning_team:
+            player_stats[person_id]['wins'] += 1
+    return ([(name, score) for name, score in score_rows],
+            [(stats['name'], stats['matches'], stats['wins']) for stats in player_stats.values()])
+
+def merge_leaderboard_totals(parts):
+    # 按姓名相加各俱乐部的 leaderboard_totals，保持各自出现的先后顺序
+    scores = {}
+    win_stats = {}
+    for score_rows, win_rows in parts:
+        for name, score in score_rows:
+            scores[name] = scores.get(name, 0) + score
+        for name, matches, wins in win_rows:
+            total = win_stats.setdefault(name, [0, 0])
+            total[0] += matches
+            total[1] += wins
+    return list(scores.items()), [(name, matches, wins) for name, (matches, wins) in win_stats.items()]
+
+def rank_leaderboards(score_rows, win_rows):
+    sorted_score_rankings = sorted(score_rows, key=lambda x: x[1], reverse=True)
+    score_rankings = [(i + 1, name, score) for i, (name, score) in enumerate(sorted_score_rankings)]
 
     # 计算胜率并排序
     win_rate_rankings = []
-    for name, stats in player_stats.items():
-        win_rate = stats['wins'] / stats['matches'] if stats['matches'] > 0 else 0
-        win_rate_rankings.append((name, stats['matches'], stats['wins'], win_rate))
+    for name, matches, wins in win_rows:
+        win_rate = wins / matches if matches > 0 else 0
+        win_rate_rankings.append((name, matches, wins, win_rate))
     sorted_win_rate_rankings = sorted(win_rate_rankings, key=lambda x: (x[3], x[1]), reverse=True)
-    win_rate_rankings_with_index = [(i + 1, name, matches, wins, f"{win_rate:.2%}") for i, (name, matches, wins, win_rate) in enumerate(sorted_win_rate_rankings)]
+    win_rate_rankings = [(i + 1, name, matches, wins, f"{win_rate:.2%}") for i, (name, matches, wins, win_rate) in enumerate(sorted_win_rate_rankings)]
+
+    return score_rankings, win_rate_rankings
+
+def compute_leaderboards():
+    return rank_leaderboards(*leaderboard_totals())
+
+def encode_match_cursor(match):
+    # 游标记录上一页最后一场比赛的 (时间, id)，时间为空时记为 null
+    return f"{match.time.isoformat() if match.time else 'null'}~{match.id}"
 
-    return render_template('index.html', matches=matches, score_rankings=score_rankings_with_index, win_rate_rankings=win_rate_rankings_with_index)
+def decode_match_cursor(cursor):
+    try:
+        time_part, id_part = cursor.rsplit('~', 1)
+        time = None if time_part == 'null' else datetime.datetime.fromisoformat(time_part)
+        return time, int(id_part)
+    except ValueError:
+        return None
+
+def match_page(cursor=None, limit=None):
+    # 按时间倒序（时间为空的排在最后、同一时间按 id 升序）分页读取比赛，使用游标而非 OFFSET，深翻页同样只走索引。
+    # 时间非空的比赛按 ix_match_time_id 的顺序读取（SQLite 中 NULL 最小，倒序时排在最后）；
+    # 读完之后再按 id 读取时间为空的比赛，两段查询都是索引上的区间扫描
+    limit = limit or app.config['MATCHES_PER_PAGE']
+    position = decode_match_cursor(cursor) if cursor else None
+    time, match_id = position if position else (None, 0)
+    matches = []
+    if not position or time is not None:
+        if position:
+            # time <= t 给出索引区间的起点，OR 条件只排除同一时间里已经读过的比赛
+            query = Match.query.filter(Match.time <= time,
+                                       db.or_(Match.time < time, db.and_(Match.time == time, Match.id > match_id)))
+            match_id = 0
+        else:
+            query = Match.query.filter(Match.time.isnot(None))
+        matches = query.order_by(Match.time.desc(), Match.id).limit(limit + 1).all()
+    if len(matches) <= limit:
+        matches += Match.query.filter(Match.time.is_(None), Match.id > match_id) \
+            .order_by(Match.id).limit(limit + 1 - len(matches)).all()
+    next_cursor = encode_match_cursor(matches[limit - 1]) if len(matches) > limit else None
+    return matches[:limit], next_cursor
+
+@app.route('/')
+def index():
+    matches, next_cursor = match_page(request.args.get('cursor'))
+
+    score_rankings, win_rate_rankings = compute_leaderboards()
+
+    return render_template('index.html', matches=matches, next_cursor=next_cursor,
+                           score_rankings=score_rankings, win_rate_rankings=win_rate_rankings,
+                           rating_rankings=rating_leaderboard())
+
+@app.route('/api/matches')
+def api_matches():
+    limit = min(request.args.get('limit', app.config['MATCHES_PER_PAGE'], type=int), 100)
+    matches, next_cursor = match_page(request.args.get('cursor'), max(limit, 1))
+    return jsonify({
+        'matches': [{
+            'id': match.id,
+            'time': match.time.isoformat() if match.time else None,
+            'time_display': match.time.strftime('%Y-%m-%d %H:%M') if match.time else '',
+            'location': match.location,
+            'player_count': match.player_count,
+            'status': match.status,
+            'url': url_for('match_detail', match_id=match.id),
+            'delete_url': url_for('delete_match', match_id=match.id),
+        } for match in matches],
+        'next_cursor': next_cursor,
+    })
+
+# === 分队平衡 ===
+def balance_tables(names):
+    # 按姓名读取历史数据，返回 (个人胜率, 组合加成表)：胜率为已结束比赛中胜 / 平 / 负记 1 / 0.5 / 0 的平均，
+    # 组合加成为两人同队时的胜率减去两人个人胜率的平均。都按 BALANCE_PRIOR_MATCHES 场虚拟比赛向期望值收缩，
+    # 没有历史的选手为 50%、没同队过的组合加成为 0
+    import numpy as np
+    prior = app.config['BALANCE_PRIOR_MATCHES']
+    n = len(names)
+    persons = dict(db.session.query(Person.name, Person.id).filter(Person.name.in_(names)))
+    indexes = {persons[name]: i for i, name in enumerate(names) if name in persons}
+    together = np.zeros((n, n))
+    together_wins = np.zeros((n, n))
+    if indexes:
+        # 只读取这几名选手的参赛记录，同场同队的选手归为一组，组合次数与胜场由一次矩阵乘法得到（对角线为个人数据）
+        result_score = db.case((MatchResult.winning_team == Player.team, 1.0),
+                               (MatchResult.winning_team.is_(None), 0.5), else_=0.0)
+        query = db.session.query(Player.match_id * 2 + Player.team, Player.person_id, result_score) \
+            .join(MatchResult, MatchResult.match_id == Player.match_id) \
+            .filter(MatchResult.finalized.is_(True), Player.person_id.in_(list(indexes)))
+        team_keys, person_ids, scores = fetch_columns(query, ('q', 'q', 'd'))
+        if len(team_keys):
+            known = np.array(sorted(indexes))
+            columns = np.array([indexes[person_id] for person_id in known])[np.searchsorted(known, person_ids)]
+            groups, rows = np.unique(team_keys, return_inverse=True)
+            members = np.zeros((len(groups), n))
+            members[rows, columns] = 1
+            group_scores = np.zeros(len(groups))
+            group_scores[rows] = scores
+            together = members.T @ members
+            together_wins = members.T @ (members * group_scores[:, np.newaxis])
+    rates = (together_wins.diagonal() + 0.5 * prior) / (together.diagonal() + prior)
+    expected = (rates[:, np.newaxis] + rates[np.newaxis, :]) / 2
+    synergy = (together_wins + expected * prior) / (together + prior) - expected
+    np.fill_diagonal(synergy, 0)
+    return rates, synergy
+
+def team_strengths(masks, rates, synergy):
+    # masks 为若干分法中奇数队的选手（布尔矩阵，每行一种分法），返回两队实力：队员平均胜率 + 队内组合平均加成。
+    # 人数为奇数时两队人数不同，所以都取平均
+    import numpy as np
+    strengths = []
+    for team in (masks, ~masks):
+        team = team.astype(float)
+        size = team[0].sum()
+        pairs = ((team @ synergy) * team).sum(axis=1) / 2
+        strengths.append(team @ rates / size + (pairs / (size * (size - 1) / 2) if size > 1 else 0))
+    return strengths
+
+def search_team_splits(rates, synergy, prefix):
+    # 枚举奇数队中序号最小的几名选手为 prefix 的全部分法，按块向量化计算两队实力差，返回 (最小差, 奇数队, 方案数)
+    import numpy as np
+    from itertools import combinations, islice
+    n = len(rates)
+    team_size = (n + 1) // 2
+    chunk = app.config['BALANCE_CHUNK']
+    rest = combinations(range(prefix[-1] + 1, n), team_size - len(prefix))
+    best = (float('inf'), None)
+    evaluated = 0
+    while True:
+        block = list(islice(rest, chunk))
+        if not block:
+            break
+        masks = np.zeros((len(block), n), dtype=bool)
+        masks[:, list(prefix)] = True
+        rows = np.repeat(np.arange(len(block)), team_size - len(prefix))
+        masks[rows, np.array(block, dtype=int).ravel()] = True
+        strength1, strength2 = team_strengths(masks, rates, synergy)
+        gaps = np.abs(strength1 - strength2)
+        i = int(gaps.argmin())
+        if gaps[i] < best[0]:
+            best = (float(gaps[i]), tuple(int(player) for player in np.flatnonzero(masks[i])))
+        evaluated += len(block)
+    return best + (evaluated,)
+
+def split_prefixes(n):
+    # 按奇数队序号最小的两名选手把全部分法分成互不重叠的几组（进程池分块的单位）；
+    # 人数为偶数时两队可以互换，固定 0 号选手在奇数队，只搜索一半
+    team_size = (n + 1) // 2
+    firsts = [0] if n % 2 == 0 else range(n - team_size + 1)
+    if team_size < 2:
+        return [(first,) for first in firsts]
+    return [(first, second) for first in firsts for second in range(first + 1, n - team_size + 2)]
+
+def balance_teams(names, workers=1):
+    # 在全部 C(n, n/2) 种分法中找两队预测实力差最小的一种；workers > 1 时各组分法分散到进程池（人数很多的探索性搜索）。
+    # 返回按座位排好的姓名（奇数队坐奇数号）、两队实力、实力差以及按原座位分队时的实力差
+    import numpy as np
+    start = time.perf_counter()
+    names = [name.strip() for name in names]
+    n = len(names)
+    rates, synergy = balance_tables(names)
+    prefixes = split_prefixes(n)
+    if workers > 1 and len(prefixes) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(search_team_splits, rates, synergy, prefix) for prefix in prefixes]
+            parts = [future.result() for future in futures]
+    else:
+        parts = [search_team_splits(rates, synergy, prefix) for prefix in prefixes]
+    gap, team1 = min(parts, key=lambda part: part[0])[:2]  # 实力差相同时取枚举顺序靠前的分法
+
+    team1_set = set(team1)
+    team2 = [i for i in range(n) if i not in team1_set]
+    seats = [None] * n
+    seats[0::2] = [names[i] for i in team1]
+    seats[1::2] = [names[i] for i in team2]
+    masks = np.zeros((2, n), dtype=bool)
+    masks[0, list(team1)] = True
+    masks[1, 0::2] = True  # 按原座位分队
+    strength1, strength2 = team_strengths(masks, rates, synergy)
+    return {
+        'seats': seats,
+        'teams': {1: [names[i] for i in team1], 2: [names[i] for i in team2]},
+        'strengths': {1: float(strength1[0]), 2: float(strength2[0])},
+        'gap': gap,
+        'parity_gap': float(abs(strength1[1] - strength2[1])),
+        'win_rates': {name: float(rate) for name, rate in zip(names, rates)},
+        'splits': sum(part[2] for part in parts),
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 1),
+    }
+
+@app.route('/api/balance_teams')
+def api_balance_teams():
+    # ?name=张三&name=李四... 按填写顺序传入全部选手，返回平衡后的座位顺序
+    names = [name.strip() for name in request.args.getlist('name')]
+    if not 2 <= len(names) <= 12 or not all(names) or len(set(names)) < len(names):
+        return jsonify({'error': '需要 2-12 个不重复的选手姓名'}), 400
+    return jsonify(balance_teams(names))
+
+@app.cli.command('balance-teams')
+@click.argument('names', nargs=-1, required=True)
+@click.option('--workers', default=1, show_default=True, help='进程数（人数很多时使用）')
+def balance_teams_command(names, workers):
+    result = balance_teams(list(names), workers)
+    click.echo(json.dumps(result, ensure_ascii=False, indent=2))
 
 @app.route('/create_match', methods=['GET', 'POST'])
 def create_match():
@@ -106,130 +1509,165 @@ def create_match():
         time = datetime.datetime.strptime(request.form['time'], '%Y-%m-%dT%H:%M')
         location = request.form['location']
 
+        # 比赛、选手、积分规则与汇总记录在同一个事务中写入
         match = Match(player_count=player_count, time=time, location=location)
         db.session.add(match)
-        db.session.commit()
+        db.session.flush()
+
+        names = [request.form[f'player_{i}'] for i in range(1, player_count + 1)]
+        balance = None
+        if request.form.get('balance_teams'):
+            # 按历史胜率和搭档数据重新排座位，使两队预测实力最接近（奇数号仍为奇数队）
+            balance = balance_teams(names)
+            names = balance['seats']
 
+        players = []
         for i in range(1, player_count + 1):
-            name = request.form[f'player_{i}']
+            person = get_or_create_person(names[i - 1])
             team = 1 if i % 2 == 1 else 2
-            player = Player(match_id=match.id, player_number=i, name=name, team=team)
+            player = Player(match_id=match.id, person_id=person.id, player_number=i, name=person.name, team=team)
             db.session.add(player)
+            players.append(player)
 
         for i in range(1, player_count + 1):
             points = int(request.form[f'points_{i}'])
             rule = ScoreRule(match_id=match.id, rank=i, points=points)
             db.session.add(rule)
 
+        init_match_result(match, players)
         db.session.commit()
+        invalidate_report(match.time)
         flash('比赛创建成功！')
+        if balance is not None:
+            flash(f"已平衡分队：奇数队 {'、'.join(balance['teams'][1])}，偶数队 {'、'.join(balance['teams'][2])}"
+                  f"（预测实力差 {balance['gap']:.1%}，按原座位为 {balance['parity_gap']:.1%}）")
         return redirect(url_for('index'))
 
     return render_template('create_match.html')
 
 @app.route('/match/<int:match_id>', methods=['GET', 'POST'])
 def match_detail(match_id):
-    match = Match.query.get_or_404(match_id)
-    players = Player.query.filter_by(match_id=match_id).all()
+    # 一次性加载比赛、选手及其汇总结果（查看页面时连同全部成绩），查询次数与轮数无关
+    load_options = [joinedload(Match.result), selectinload(Match.players).selectinload(Player.result)]
+    if request.method == 'GET':
+        load_options.append(selectinload(Match.match_rounds))
+    match = Match.query.options(*load_options).get_or_404(match_id)
+    players = match.players
 
     if request.method == 'POST':
         if 'submit_scores' in request.form:
-            round_number = RoundScore.query.filter_by(match_id=match_id).count() // match.player_count + 1
-            rules = {rule.rank: rule.points for rule in ScoreRule.query.filter_by(match_id=match_id).all()}
-
-            selected_players = set()
-            for i in range(1, match.player_count + 1):
-                player_id = int(request.form[f'player_{i}'])
-                if player_id in selected_players:
-                    flash('错误：同一选手不能重复出现在成绩中！')
-                    return redirect(url_for('match_detail', match_id=match_id))
-                selected_players.add(player_id)
-
-            for i in range(1, match.player_count + 1):
-                player_id = int(request.form[f'player_{i}'])
-                rank = i
-                points = rules[rank]
-                score = RoundScore(
-                    match_id=match_id,
-                    round_number=round_number,
-                    player_id=player_id,
-                    rank=rank,
-                    points=points
-                )
-                db.session.add(score)
-
-            db.session.commit()
+            try:
+                player_ids = [int(request.form[f'player_{i}']) for i in range(1, match.player_count + 1)]
+                expected_round = request.form.get('round_number', type=int)
+            except (KeyError, ValueError):
+                player_ids, expected_round = [], None
+            error = submit_round(match, player_ids, expected_round)
+            if error:
+                flash(error)
+                return redirect(url_for('match_detail', match_id=match_id))
+            invalidate_report(match.time)
+            match_updates.notify()
             flash('本轮成绩录入成功！')
 
         elif 'end_match' in request.form:
-            match.status = 'finished'
-            db.session.commit()
+            error = end_match(match)
+            if error:
+                flash(error)
+                return redirect(url_for('match_detail', match_id=match_id))
+            invalidate_report(match.time)
+            match_updates.notify()
+            if app.config['REPORT_BACKGROUND'] and app.config['REPORT_PRECOMPUTE_ON_FINISH'] and match.time:
+                year = match.time.year
+                submit_report_job(f'annual:{year}', year_fingerprint(year), 'annual_report.html',
+                                  compute_annual_report, year)
             flash('比赛已结束！')
 
         return redirect(url_for('match_detail', match_id=match_id))
 
-    scores = RoundScore.query.filter_by(match_id=match_id).all()
-    rounds = {}
-    for score in scores:
-        if score.round_number not in rounds:
-            rounds[score.round_number] = []
-        rounds[score.round_number].append(score)
-
-    total_scores = {}
-    for player in players:
-        player_scores = RoundScore.query.filter_by(match_id=match_id, player_id=player.id).all()
-        total_scores[player.id] = sum(score.points for score in player_scores)
+    total_scores = {player.id: player.result.total_score if player.result else 0 for player in players}
 
     sorted_players = sorted(players, key=lambda p: total_scores.get(p.id, 0), reverse=True)
 
-    team_scores = {1: 0, 2: 0}
-    for player in players:
-        team_scores[player.team] += total_scores.get(player.id, 0)
+    team_scores = match.result.team_scores
 
     score_difference = abs(team_scores[1] - team_scores[2])
     leading_team = 1 if team_scores[1] > team_scores[2] else 2 if team_scores[2] > team_scores[1] else None
 
-    # 计算级牌
-    level_cards = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
-    team_levels = {1: 0, 2: 0}  # 初始级牌为 '2'，索引 0
-
-    for round_num in sorted(rounds.keys()):
-        round_scores = rounds[round_num]
-        # 按名次排序
-        sorted_round_scores = sorted(round_scores, key=lambda x: x.rank)
-
-        # 计算每队本轮的名次
-        team_ranks = {1: [], 2: []}
-        for score in sorted_round_scores:
-            player = Player.query.get(score.player_id)
-            team_ranks[player.team].append(score.rank)
-
-        # 确定第一名的队伍
-        first_team = Player.query.get(sorted_round_scores[0].player_id).team
-
-        # 计算完全领先人数
-        if team_ranks[1] and team_ranks[2]:  # 确保两队都有数据
-            if first_team == 1:
-                opponent_best_rank = min(team_ranks[2])  # 偶数队最好名次
-                leading_count = sum(1 for rank in team_ranks[1] if rank < opponent_best_rank)
-                team_levels[1] = min(team_levels[1] + leading_count, len(level_cards) - 1)
-            elif first_team == 2:
-                opponent_best_rank = min(team_ranks[1])  # 奇数队最好名次
-                leading_count = sum(1 for rank in team_ranks[2] if rank < opponent_best_rank)
-                team_levels[2] = min(team_levels[2] + leading_count, len(level_cards) - 1)
-
-    team_level_display = {1: level_cards[team_levels[1]], 2: level_cards[team_levels[2]]}
+    # 级牌直接读取录入成绩时维护的状态
+    team_level_display = {team: LEVEL_CARDS[level] for team, level in match.result.team_levels.items()}
+    level_history = {r.round_number: r for r in match.match_rounds}
+    score_chart = score_progression_chart(match.match_rounds)
+    round_tables = render_round_tables(match, level_history)
 
     return render_template('match_detail.html',
                          match=match,
                          players=players,
                          sorted_players=sorted_players,
-                         rounds=rounds,
+                         round_tables=round_tables,
                          total_scores=total_scores,
                          team_scores=team_scores,
                          score_difference=score_difference,
                          leading_team=leading_team,
-                         team_levels=team_level_display)
+                         team_levels=team_level_display,
+                         level_history=level_history,
+                         score_chart=score_chart,
+                         level_cards=LEVEL_CARDS,
+                         next_round=match.result.rounds + 1)
+
+def render_round_tables(match, level_history):
+    # 每轮成绩表按轮次倒序渲染。已录入的轮次不会再变化，直接使用缓存的 HTML，只查询、渲染缓存中没有的轮次；
+    # 进行中比赛的最新一轮每次重新渲染。比赛 id 不会复用（AUTOINCREMENT），其他进程删除比赛后残留的缓存不会被新比赛命中；
+    # 缓存中另外保存比赛时间作为校验。
+    round_numbers = sorted(level_history, reverse=True)
+    live_round = round_numbers[0] if round_numbers and match.status == 'ongoing' else None
+    club = current_club()
+    tables = {}
+    for round_number in round_numbers:
+        if round_number == live_round:
+            continue
+        entry = round_fragments.get((club, match.id, round_number))
+        if entry is not None and entry[0] == match.time:
+            tables[round_number] = entry[1]
+
+    missing = [round_number for round_number in round_numbers if round_number not in tables]
+    if missing:
+        scores = defaultdict(list)
+        for score in RoundScore.query.filter(RoundScore.match_id == match.id, RoundScore.round_number.in_(missing)) \
+                .order_by(RoundScore.id):
+            scores[score.round_number].append(score)
+        for round_number in missing:
+            tables[round_number] = Markup(render_template('round_table.html',
+                                                          round=round_number,
+                                                          scores=scores[round_number],
+                                                          state=level_history[round_number],
+                                                          level_cards=LEVEL_CARDS))
+            if round_number != live_round:
+                round_fragments.put((club, match.id, round_number), (match.time, tables[round_number]))
+    return [tables[round_number] for round_number in round_numbers]
+
+def invalidate_round_fragments(match_id, rounds):
+    club = current_club()
+    for round_number in range(1, rounds + 1):
+        round_fragments.invalidate((club, match_id, round_number))
+
+def score_progression_chart(match_rounds, width=600, height=220, padding=30):
+    # 比分走势图：两队累计总分随轮次变化的 SVG 折线坐标，直接由逐轮记录得到
+    if not match_rounds:
+        return None
+    top = max(max(r.team1_score, r.team2_score) for r in match_rounds) or 1
+    step = (width - 2 * padding) / len(match_rounds)
+
+    def to_y(score):
+        return height - padding - score / top * (height - 2 * padding)
+
+    def points(attr):
+        coords = [(padding, to_y(0))] + [(padding + i * step, to_y(getattr(r, attr)))
+                                         for i, r in enumerate(match_rounds, start=1)]
+        return ' '.join(f'{x:.1f},{y:.1f}' for x, y in coords)
+
+    return {'width': width, 'height': height, 'padding': padding, 'max_score': top,
+            'team1': points('team1_score'), 'team2': points('team2_score'),
+            'labels': [(padding + i * step, r.round_number) for i, r in enumerate(match_rounds, start=1)]}
 
 @app.route('/delete_match/<int:match_id>', methods=['POST'])
 def delete_match(match_id):
@@ -240,439 +1678,1190 @@ def delete_match(match_id):
 
     ScoreRule.query.filter_by(match_id=match_id).delete()
     RoundScore.query.filter_by(match_id=match_id).delete()
+    match_time = match.time
+    rounds = match.result.rounds if match.result else 0
     db.session.delete(match)
     db.session.commit()
+    invalidate_report(match_time)
+    invalidate_round_fragments(match_id, rounds)
+    match_updates.notify()
     flash('比赛已删除！')
     return redirect(url_for('index'))
 
+# === 实时比分 API ===
+def match_etag(match_id):
+    # 只读取比赛状态、时间和汇总的轮数，不访问成绩表；比赛不存在时返回 None。
+    # SQLite 下比赛 id 不复用；另外带上比赛时间，在 id 可能复用的其他数据库上，删除后新建的比赛也不会沿用旧比赛的 ETag
+    row = db.session.query(Match.status, Match.time, MatchResult.rounds) \
+        .join(MatchResult, MatchResult.match_id == Match.id) \
+        .filter(Match.id == match_id).first()
+    if row is None:
+        return None
+    created = row.time.strftime('%Y%m%d%H%M%S') if row.time else 'none'
+    return f'match-{match_id}-{created}-round-{row.rounds}-{row.status}'
+
+def wait_for_match_change(match_id, etag, timeout):
+    # 等待比赛的 ETag 变化或超时，返回最新的 ETag
+    deadline = time.monotonic() + timeout
+    while True:
+        version = match_updates.version
+        current = match_etag(match_id)
+        db.session.close()  # 等待期间不占用数据库连接
+        remaining = deadline - time.monotonic()
+        if current != etag or remaining <= 0:
+            return current
+        match_updates.wait(version, min(remaining, app.config['LIVE_RECHECK_INTERVAL']))
+
+def match_scoreboard(match_id):
+    # 比赛在读取 ETag 之后被删除时返回 None
+    match = Match.query.options(joinedload(Match.result),
+                                selectinload(Match.players).selectinload(Player.result),
+                                selectinload(Match.match_rounds)).get(match_id)
+    if match is None:
+        return None
+    team_scores = match.result.team_scores
+    leading_team, _ = match_outcome(team_scores)
+    players = sorted(match.players, key=lambda p: p.result.total_score if p.result else 0, reverse=True)
+    return {
+        'match_id': match.id,
+        'status': match.status,
+        'rounds': match.result.rounds,
+        'team_scores': team_scores,
+        'leading_team': leading_team,
+        'score_difference': abs(team_scores[1] - team_scores[2]),
+        'team_levels': {team: LEVEL_CARDS[level] for team, level in match.result.team_levels.items()},
+        'players': [{
+            'id': player.id,
+            'name': player.name,
+            'team': player.team,
+            'total_score': player.result.total_score if player.result else 0,
+            'first_places': player.result.first_places if player.result else 0,
+        } for player in players],
+        'timeline': [dict({field: getattr(r, field) for field in TIMELINE_FIELDS}, lead=r.lead)
+                     for r in match.match_rounds],
+    }
+
+@app.route('/api/match/<int:match_id>')
+def api_match(match_id):
+    # 支持 If-None-Match 条件请求；带 ?wait=秒数 时作为长轮询，等到有新成绩或超时再返回
+    etag = match_etag(match_id)
+    if etag is None:
+        return jsonify({'error': '比赛不存在'}), 404
+    if request.if_none_match.contains(etag):
+        wait = min(request.args.get('wait', 0, type=int), app.config['LIVE_POLL_TIMEOUT'])
+        if wait > 0:
+            etag = wait_for_match_change(match_id, etag, wait)
+            if etag is None:
+                return jsonify({'error': '比赛不存在'}), 404
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+    scoreboard = match_scoreboard(match_id)
+    if scoreboard is None:
+        return jsonify({'error': '比赛不存在'}), 404
+    response = jsonify(scoreboard)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/match/<int:match_id>/events')
+def api_match_events(match_id):
+    # Server-Sent Events：每录入一轮（或比赛结束）推送一次最新比分，连接超时后由浏览器携带 Last-Event-ID 自动重连
+    if match_etag(match_id) is None:
+        return jsonify({'error': '比赛不存在'}), 404
+    last_etag = request.headers.get('Last-Event-ID')
+
+    def stream():
+        etag = last_etag
+        deadline = time.monotonic() + app.config['LIVE_POLL_TIMEOUT']
+        while True:
+            remaining = deadline - time.monotonic()
+            current = wait_for_match_change(match_id, etag, max(remaining, 0))
+            if current is not None and current != etag:
+                scoreboard = match_scoreboard(match_id)
+                db.session.close()
+                if scoreboard is None:
+                    current = None  # 读取 ETag 之后比赛被删除
+            if current is None:
+                yield 'event: deleted\ndata: {}\n\n'
+                return
+            if current != etag:
+                etag = current
+                data = json.dumps(scoreboard, ensure_ascii=False)
+                yield f'id: {etag}\nevent: scoreboard\ndata: {data}\n\n'
+            if time.monotonic() >= deadline:
+                return
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# === 胜率模拟 ===
+def simulate_match(teams, points, team_scores, levels, rounds, simulations, rank_cdf=None, seed=None):
+    # 向量化蒙特卡洛：一次抽取 simulations × rounds 轮的名次，按级牌规则推进，返回可以逐块相加的计数。
+    # teams 为各选手的队伍，points 为按名次排列的积分；rank_cdf 为各选手名次分布的累积概率（None 表示名次均匀随机）
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    teams = np.asarray(teams)
+    points = np.asarray(points)
+    n = len(teams)
+    shape = (simulations, rounds, n)
+    if rank_cdf is None:
+        keys = rng.random(shape)
+    else:
+        # 每位选手按自己的名次分布抽一个名次，再加上 [0, 1) 的随机数决定相同名次之间的先后
+        uniform = rng.random(shape)
+        keys = np.empty(shape)
+        for i in range(n):
+            keys[..., i] = np.searchsorted(rank_cdf[i], uniform[..., i], side='right')
+        keys += rng.random(shape)
+    ranked_teams = teams[np.argsort(keys, axis=-1)]  # [模拟, 轮次, 名次] -> 队伍
+
+    team1_points = (ranked_teams == 1) @ points
+    team2_points = (ranked_teams == 2) @ points
+    final1 = team_scores[1] + team1_points.sum(axis=1)
+    final2 = team_scores[2] + team2_points.sum(axis=1)
+
+    # 级牌规则（同 level_advance）：第一名所在队伍升级数为从第一名起连续同队的人数，所有人同队时不升级；
+    # 级牌只升不降，逐轮封顶与最后一次封顶结果相同
+    first = ranked_teams[..., 0]
+    advance = np.cumprod(ranked_teams == first[..., np.newaxis], axis=-1).sum(axis=-1)
+    advance[advance == n] = 0
+    top = len(LEVEL_CARDS) - 1
+    level1 = np.minimum(levels[1] + np.where(first == 1, advance, 0).sum(axis=1), top)
+    level2 = np.minimum(levels[2] + np.where(first == 2, advance, 0).sum(axis=1), top)
+
+    return {
+        'simulations': simulations,
+        'outcomes': np.array([(final1 > final2).sum(), (final2 > final1).sum(), (final1 == final2).sum()]),
+        'score_sums': np.array([final1.sum(), final2.sum()]),
+        'levels': np.array([np.bincount(level1, minlength=top + 1), np.bincount(level2, minlength=top + 1)]),
+    }
+
+def run_simulations(inputs, simulations, workers=1, seed=None):
+    # 按 SIMULATION_CHUNK 分块计算（限制单块数组大小），workers > 1 时各块分散到进程池
+    import numpy as np
+    chunk = app.config['SIMULATION_CHUNK']
+    sizes = [min(chunk, simulations - start) for start in range(0, simulations, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(inputs['teams'], inputs['points'], inputs['team_scores'], inputs['levels'], inputs['rounds'],
+             size, inputs['rank_cdf'], child) for size, child in zip(sizes, seeds)]
+    if workers > 1 and len(args) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = [future.result() for future in [executor.submit(simulate_match, *arg) for arg in args]]
+    else:
+        parts = [simulate_match(*arg) for arg in args]
+    total = parts[0]
+    for part in parts[1:]:
+        total = {key: total[key] + part[key] for key in total}
+    return total
+
+def typical_rounds(player_count):
+    # 同人数已结束比赛的平均轮数，没有历史数据时使用 SIMULATION_DEFAULT_ROUNDS
+    average = db.session.query(db.func.avg(MatchResult.rounds)) \
+        .join(Match, Match.id == MatchResult.match_id) \
+        .filter(MatchResult.finalized.is_(True), Match.player_count == player_count) \
+        .scalar()
+    return round(average) if average else app.config['SIMULATION_DEFAULT_ROUNDS']
+
+def rank_distributions(match, players):
+    # 各选手最近 SIMULATION_HISTORY_MATCHES 场其他比赛的名次分布（按比例换算到本场人数），每个名次加 1 平滑，
+    # 返回累积概率矩阵。只取最近的比赛，查询量与历史总场数无关
+    import numpy as np
+    n = match.player_count
+    counts = np.ones((len(players), n))
+    indexes = defaultdict(list)
+    for i, player in enumerate(players):
+        indexes[player.person_id].append(i)
+    recent = db.session.query(
+        Player.id,
+        Player.person_id,
+        Player.match_id,
+        db.func.row_number().over(partition_by=Player.person_id, order_by=Player.match_id.desc()).label('recency')
+    ).filter(Player.person_id.in_(list(indexes)), Player.match_id != match.id).subquery()
+    rows = db.session.query(recent.c.person_id, Match.player_count, RoundScore.rank, db.func.count(RoundScore.id)) \
+        .select_from(recent) \
+        .join(Match, Match.id == recent.c.match_id) \
+        .join(RoundScore, RoundScore.player_id == recent.c.id) \
+        .filter(recent.c.recency <= app.config['SIMULATION_HISTORY_MATCHES']) \
+        .group_by(recent.c.person_id, Match.player_count, RoundScore.rank)
+    for person_id, size, rank, count in rows:
+        position = round((rank - 1) * (n - 1) / (size - 1)) if size > 1 else 0
+        for i in indexes[person_id]:
+            counts[i, min(max(position, 0), n - 1)] += count
+    cdf = np.cumsum(counts, axis=1)
+    return cdf / cdf[:, -1:]
+
+def match_forecast(match_id, simulations, rounds=None, model='uniform', workers=1, seed=None):
+    # 进行中比赛的胜率与最终级牌预测；比赛不存在返回 None
+    match = Match.query.options(joinedload(Match.result), selectinload(Match.players)).get(match_id)
+    if match is None:
+        return None
+    players = match.players
+    played = match.result.rounds
+    if match.status == 'finished':
+        rounds = 0  # 已结束的比赛结果确定
+    elif rounds is None:
+        rounds = max(typical_rounds(match.player_count) - played, 1)
+    inputs = {
+        'teams': [player.team for player in players],
+        'points': [rule.points for rule in ScoreRule.query.filter_by(match_id=match_id).order_by(ScoreRule.rank)],
+        'team_scores': match.result.team_scores,
+        'levels': match.result.team_levels,
+        'rounds': rounds,
+        'rank_cdf': rank_distributions(match, players) if model == 'history' else None,
+    }
+    start = time.perf_counter()
+    total = run_simulations(inputs, simulations, workers, seed)
+    elapsed = time.perf_counter() - start
+
+    count = total['simulations']
+    wins1, wins2, draws = (int(value) for value in total['outcomes'])
+    forecast = {'match_id': match_id, 'status': match.status, 'rounds_played': played, 'rounds_simulated': rounds,
+                'model': model, 'simulations': count,
+                'win_probability': {1: wins1 / count, 2: wins2 / count}, 'draw_probability': draws / count,
+                'expected_scores': {1: float(total['score_sums'][0]) / count,
+                                    2: float(total['score_sums'][1]) / count},
+                'expected_levels': {}, 'likely_levels': {}, 'level_distribution': {},
+                'elapsed_ms': round(elapsed * 1000, 1)}
+    for team, histogram in ((1, total['levels'][0]), (2, total['levels'][1])):
+        probabilities = histogram / count
+        forecast['expected_levels'][team] = float(probabilities @ range(len(LEVEL_CARDS)))
+        forecast['likely_levels'][team] = LEVEL_CARDS[int(histogram.argmax())]
+        forecast['level_distribution'][team] = {LEVEL_CARDS[level]: float(p) for level, p in enumerate(probabilities) if p}
+    return forecast
+
+@app.route('/api/match/<int:match_id>/forecast')
+def api_match_forecast(match_id):
+    # ?simulations= 模拟次数（上限 SIMULATION_MAX），?rounds= 剩余轮数（默认按同人数比赛的平均轮数估计），
+    # ?model=history 按选手历史名次分布抽样（默认名次均匀随机）
+    simulations = min(max(request.args.get('simulations', app.config['SIMULATION_COUNT'], type=int), 1),
+                      app.config['SIMULATION_MAX'])
+    rounds = request.args.get('rounds', type=int)
+    model = 'history' if request.args.get('model') == 'history' else 'uniform'
+    forecast = match_forecast(match_id, simulations, max(rounds, 1) if rounds else None, model)
+    if forecast is None:
+        return jsonify({'error': '比赛不存在'}), 404
+    return jsonify(forecast)
+
+@app.cli.command('simulate-match')
+@click.argument('match_id', type=int)
+@click.option('--simulations', default=1000000, show_default=True, help='模拟次数')
+@click.option('--rounds', type=int, help='剩余轮数，默认按同人数比赛的平均轮数估计')
+@click.option('--history', is_flag=True, help='按选手历史名次分布抽样')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='进程数')
+@click.option('--seed', type=int, help='随机种子')
+def simulate_match_command(match_id, simulations, rounds, history, workers, seed):
+    forecast = match_forecast(match_id, simulations, rounds, 'history' if history else 'uniform', workers, seed)
+    if forecast is None:
+        raise click.ClickException(f'比赛 {match_id} 不存在')
+    click.echo(json.dumps(forecast, ensure_ascii=False, indent=2))
+
 @app.route('/annual_report')
 def annual_report():
-    import numpy as np
-    from collections import defaultdict, Counter
-    
     # 获取年度参数（默认当前年）
     year = request.args.get('year', datetime.datetime.now().year, type=int)
-    
-    # 获取该年度所有比赛
-    matches = Match.query.filter(
-        db.extract('year', Match.time) == year
-    ).all()
-    
-    if not matches:
+    if year not in REPORT_YEARS:
+        # 超出可统计范围的年份不可能有比赛，直接显示无数据页面（也不占用报告缓存）
         return render_template('annual_report.html', year=year, no_data=True)
+
+    if app.config['REPORT_BACKGROUND']:
+        return background_report(f'annual:{year}', year_fingerprint(year), 'annual_report.html',
+                                 compute_annual_report, year)
+
+    fingerprint = year_fingerprint(year) if app.config['REPORT_CACHE_VALIDATE'] else None
+    entry = report_cache.get((current_club(), year))
+    if entry is None or entry[0] != fingerprint:
+        entry = (fingerprint, compute_annual_report(year))
+        report_cache.put((current_club(), year), entry)
+    return render_template('annual_report.html', **entry[1])
+
+@app.route('/annual_report/cache_stats')
+def annual_report_cache_stats():
+    return jsonify(report_cache.stats())
+
+@app.route('/match/cache_stats')
+def round_fragment_cache_stats():
+    stats = round_fragments.stats()
+    del stats['keys']  # 轮次很多，只返回计数
+    return jsonify(stats)
+
+def pair_stats_kernel(participations, winning_teams, n_persons):
+    # 搭档/对手统计核：把参赛记录装入 (选手序号 × 比赛) 稠密矩阵，用矩阵乘法一次算出两两组合的
+    # 同队场次、同队获胜场次和对战场次。participations 为 (比赛序号, 选手序号, 队伍) 列表。
+    import numpy as np
+    n_matches = len(winning_teams)
+    team1 = np.zeros((n_persons, n_matches))
+    team2 = np.zeros((n_persons, n_matches))
+    won = np.zeros((n_persons, n_matches))  # 所在队伍获胜（平局不算）
+    if participations:
+        match_idx, person_idx, teams = (np.array(column) for column in zip(*participations))
+        winners = np.array([team or 0 for team in winning_teams])
+        team1[person_idx[teams == 1], match_idx[teams == 1]] = 1
+        team2[person_idx[teams == 2], match_idx[teams == 2]] = 1
+        on_winner = winners[match_idx] == teams
+        won[person_idx[on_winner], match_idx[on_winner]] = 1
+
+    together = team1 @ team1.T + team2 @ team2.T
+    together_wins = won @ won.T  # 两人都在获胜队伍中即为同队获胜
+    against = team1 @ team2.T + team2 @ team1.T
+    matrices = [np.rint(m).astype(np.int64) for m in (together, together_wins, against)]
+    for m in matrices:
+        np.fill_diagonal(m, 0)
+    return tuple(matrices)
+
+def compute_annual_report(year):
+    import numpy as np
     
-    # === 基础统计 ===
-    total_matches = len(matches)
-    finished_matches = [m for m in matches if m.status == 'finished']
-    total_rounds = sum(len(RoundScore.query.filter_by(match_id=m.id).all()) // m.player_count for m in matches)
-    
-    # 参与人次
-    all_players = []
-    for match in matches:
-        players = Player.query.filter_by(match_id=match.id).all()
-        all_players.extend(players)
-    total_participations = len(all_players)
-    unique_players = len(set(p.name for p in all_players))
-    
-    # 时间分布（按月）
-    monthly_distribution = defaultdict(int)
-    for match in matches:
-        month = match.time.month
-        monthly_distribution[month] += 1
-    monthly_data = [{'month': f'{m}月', 'count': monthly_distribution.get(m, 0)} for m in range(1, 13)]
+    snapshot = year_snapshot(year)
+    n_matches = len(snapshot.match_ids)
+    if not n_matches:
+        return {'year': year, 'no_data': True}
+    n_players = len(snapshot.player_ids)
     
-    # 地点热度 TOP3
-    location_counter = Counter(m.location for m in matches)
-    top_locations = location_counter.most_common(3)
+    # 按选手（每场比赛的 Player）汇总逐轮成绩：总分、头名次数、名次和与平方和、单轮最高分、最好/最差名次
+    score_player = snapshot.score_player
+    ranks = snapshot.score_ranks.astype(np.int64)
+    points = snapshot.score_points.astype(np.int64)
+    rank_counts = np.bincount(score_player, minlength=n_players)
+    totals = np.bincount(score_player, weights=points, minlength=n_players).astype(np.int64).tolist()
+    first_places = np.bincount(score_player[ranks == 1], minlength=n_players).tolist()
+    rank_sums = np.bincount(score_player, weights=ranks, minlength=n_players).astype(np.int64).tolist()
+    rank_square_sums = np.bincount(score_player, weights=ranks * ranks, minlength=n_players).astype(np.int64).tolist()
+    best_round = np.zeros(n_players, dtype=np.int64)
+    np.maximum.at(best_round, score_player, points)
+    best_rank = np.full(n_players, np.iinfo(np.int64).max)
+    np.minimum.at(best_rank, score_player, ranks)
+    worst_rank = np.zeros(n_players, dtype=np.int64)
+    np.maximum.at(worst_rank, score_player, ranks)
+    # 本场首次出现的成绩位置，决定选手计入统计的顺序（与逐行读取成绩时一致）；没有成绩的选手排在最后
+    first_seen = np.arange(len(score_player), len(score_player) + n_players)
+    scored, first_index = np.unique(score_player, return_index=True)
+    first_seen[scored] = first_index
+    first_seen = first_seen.tolist()
+    best_round, best_rank, worst_rank = best_round.tolist(), best_rank.tolist(), worst_rank.tolist()
+    rank_counts = rank_counts.tolist()
     
-    # 最早/最晚开始时间
-    earliest_match = min(matches, key=lambda m: m.time.time()) if matches else None
-    latest_match = max(matches, key=lambda m: m.time.time()) if matches else None
+    match_times = snapshot.match_times
+    player_counts = snapshot.player_counts.tolist()
+    finished = snapshot.finished.tolist()
+    persons = snapshot.player_persons.tolist()
+    teams = snapshot.player_teams.tolist()
+    player_offsets = snapshot.player_offsets.tolist()
+    score_counts = np.diff(snapshot.score_offsets).tolist()
+    round_offsets = snapshot.round_offsets.tolist()
+    round_numbers = snapshot.round_numbers.tolist()
+    team1_points = snapshot.round_team1_points.tolist()
+    team2_points = snapshot.round_team2_points.tolist()
+    leads = snapshot.round_leads.tolist()
     
-    # 获取这两场比赛的玩家列表
-    earliest_players = Player.query.filter_by(match_id=earliest_match.id).all() if earliest_match else []
-    latest_players = Player.query.filter_by(match_id=latest_match.id).all() if latest_match else []
+    # === 基础统计 ===
+    total_matches = n_matches
+    finished_matches_count = 0
+    total_rounds = 0
+    total_participations = n_players
+    names = {}  # person_id -> 选手姓名
+    monthly_distribution = defaultdict(int)
+    location_counter = Counter(snapshot.locations)
+    earliest = latest = None  # 比赛序号
     
     # === 荣誉榜单 ===
-    # 计算每个选手的统计数据
+    # 计算每个选手的统计数据（以 person_id 为键）
     player_stats = defaultdict(lambda: {
         'total_score': 0,
         'matches': 0,
         'wins': 0,
         'first_place': 0,
-        'ranks': [],
+        'rank_count': 0,
+        'rank_sum': 0,
+        'rank_square_sum': 0,
         'comebacks': 0,
         'profit': 0,  # 收益/亏损
         'max_single_round_score': 0,  # 单轮最高分
         'match_rank_ranges': [],  # 每场比赛的名次范围（用于计算过山车）
-        'teammates': defaultdict(lambda: {'matches': 0, 'wins': 0}),
-        'opponents': defaultdict(lambda: {'matches': 0, 'wins': 0})
     })
+    # 已结束比赛的参赛记录 (比赛序号, person_id, 队伍) 与每场获胜队伍，供搭档/对手统计核使用
+    participations = []
+    winning_teams = []
     
-    for match in finished_matches:
-        players = Player.query.filter_by(match_id=match.id).all()
-        round_scores = RoundScore.query.filter_by(match_id=match.id).all()
-        
-        # 计算个人总分
-        player_total_scores = defaultdict(int)
-        player_match_ranks = defaultdict(list)  # 记录每个选手在本场比赛中的名次
-        for score in round_scores:
-            player = Player.query.get(score.player_id)
-            player_total_scores[player.id] = player_total_scores.get(player.id, 0) + score.points
-            player_stats[player.name]['total_score'] += score.points
-            player_stats[player.name]['ranks'].append(score.rank)
-            player_match_ranks[player.name].append(score.rank)  # 记录本场名次
-            
-            # 更新单轮最高分
-            if score.points > player_stats[player.name]['max_single_round_score']:
-                player_stats[player.name]['max_single_round_score'] = score.points
-            
-            if score.rank == 1:
-                player_stats[player.name]['first_place'] += 1
+    # === 年度之最 ===
+    max_single_score = 0  # 单场最高分
+    max_score_player = None
+    max_score_match = None
+    max_comeback = 0  # 单轮最大翻盘
+    max_comeback_match = None
+    min_diff = float('inf')  # 最激烈比赛（分差最小）
+    closest_match = None
+    max_diff = 0  # 最悬殊比赛（分差最大）
+    most_lopsided_match = None
+    
+    for m in range(n_matches):
+        match_players = range(player_offsets[m], player_offsets[m + 1])
+        match_time = match_times[m]
+        total_rounds += score_counts[m] // player_counts[m]
+        for i in match_players:
+            names[persons[i]] = snapshot.player_names[i]
+        monthly_distribution[match_time.month] += 1
         
-        # 计算每个选手在本场比赛的名次波动（过山车）
-        for player_name, ranks in player_match_ranks.items():
-            if len(ranks) > 1:
-                rank_range = max(ranks) - min(ranks)  # 最大名次 - 最小名次
-                player_stats[player_name]['match_rank_ranges'].append(rank_range)
+        # 最早/最晚开始时间
+        if earliest is None or match_time.time() < match_times[earliest].time():
+            earliest = m
+        if latest is None or match_time.time() > match_times[latest].time():
+            latest = m
         
-        # 计算队伍总分
-        team_scores = {1: 0, 2: 0}
-        for player in players:
-            team_scores[player.team] += player_total_scores.get(player.id, 0)
+        if not finished[m]:
+            continue
+        finished_matches_count += 1
         
-        winning_team = 1 if team_scores[1] > team_scores[2] else 2 if team_scores[2] > team_scores[1] else None
+        # 累加个人成绩，并计算每个选手在本场比赛的名次波动（过山车）
+        match_ranks = {}  # person_id -> (最好名次, 最差名次, 成绩数)
+        for i in sorted(match_players, key=first_seen.__getitem__):
+            stats = player_stats[persons[i]]
+            if not rank_counts[i]:
+                continue
+            stats['total_score'] += totals[i]
+            stats['first_place'] += first_places[i]
+            stats['rank_count'] += rank_counts[i]
+            stats['rank_sum'] += rank_sums[i]
+            stats['rank_square_sum'] += rank_square_sums[i]
+            stats['max_single_round_score'] = max(stats['max_single_round_score'], best_round[i])
+            best, worst, count = match_ranks.get(persons[i], (best_rank[i], worst_rank[i], 0))
+            match_ranks[persons[i]] = (min(best, best_rank[i]), max(worst, worst_rank[i]), count + rank_counts[i])
+        for person_id, (best, worst, count) in match_ranks.items():
+            if count > 1:
+                player_stats[person_id]['match_rank_ranges'].append(worst - best)  # 最大名次 - 最小名次
         
-        # 计算收益/亏损（积分差，88封顶）
-        score_diff = abs(team_scores[1] - team_scores[2])
-        score_diff = min(score_diff, 88)  # 积分差88封顶
+        # 计算队伍总分、获胜队伍与收益/亏损（积分差，88封顶）
+        team_scores = {1: 0, 2: 0}
+        for i in match_players:
+            team_scores[teams[i]] += totals[i]
+        winning_team, score_diff = match_outcome(team_scores)
         
         # 统计胜负和参赛次数
-        for player in players:
-            name = player.name
-            player_stats[name]['matches'] += 1
+        for i in match_players:
+            person_id = persons[i]
+            player_stats[person_id]['matches'] += 1
             
-            if winning_team and player.team == winning_team:
-                player_stats[name]['wins'] += 1
-                player_stats[name]['profit'] += score_diff  # 赢家获得积分差（最多88）
+            if winning_team and teams[i] == winning_team:
+                player_stats[person_id]['wins'] += 1
+                player_stats[person_id]['profit'] += score_diff  # 赢家获得积分差（最多88）
             elif winning_team:
-                player_stats[name]['profit'] -= score_diff  # 输家失去积分差（最多88）
+                player_stats[person_id]['profit'] -= score_diff  # 输家失去积分差（最多88）
             elif not winning_team:  # 平局算半场胜利
-                player_stats[name]['wins'] += 1
+                player_stats[person_id]['wins'] += 1
+            participations.append((len(winning_teams), person_id, teams[i]))
             
-            # 记录队友和对手
-            for other_player in players:
-                if other_player.id != player.id:
-                    if other_player.team == player.team:
-                        player_stats[name]['teammates'][other_player.name]['matches'] += 1
-                        if winning_team == player.team:
-                            player_stats[name]['teammates'][other_player.name]['wins'] += 1
-                    else:
-                        player_stats[name]['opponents'][other_player.name]['matches'] += 1
-                        if winning_team == player.team:
-                            player_stats[name]['opponents'][other_player.name]['wins'] += 1
+            # 单场最高分
+            if totals[i] > max_single_score:
+                max_single_score = totals[i]
+                max_score_player = snapshot.player_names[i]
+                max_score_match = m
+        winning_teams.append(winning_team)
         
-        # 计算翻盘次数（最后一轮从落后到领先）
-        rounds = defaultdict(list)
-        for score in round_scores:
-            rounds[score.round_number].append(score)
+        # 翻盘、单轮分差变化与最终分差读取逐轮记录（本轮两队得分、累计总分）
+        timeline = range(round_offsets[m], round_offsets[m + 1])
         
-        if len(rounds) >= 2:
-            last_round = max(rounds.keys())
-            second_last_round = last_round - 1
+        # 计算翻盘次数（最后一轮从落后到领先）
+        if len(timeline) >= 2:
+            before, after = timeline[-2], timeline[-1]
+            if round_numbers[before] == round_numbers[after] - 1:
+                if team1_points[before] < team2_points[before] and team1_points[after] > team2_points[after]:
+                    comeback_team = 1
+                elif team2_points[before] < team1_points[before] and team2_points[after] > team1_points[after]:
+                    comeback_team = 2
+                else:
+                    comeback_team = None
+                for i in match_players:
+                    if teams[i] == comeback_team:
+                        player_stats[persons[i]]['comebacks'] += 1
             
-            if second_last_round in rounds:
-                # 倒数第二轮的队伍分数
-                team_scores_before = {1: 0, 2: 0}
-                for score in rounds[second_last_round]:
-                    player = Player.query.get(score.player_id)
-                    team_scores_before[player.team] += score.points
-                
-                # 最后一轮的队伍分数
-                team_scores_after = {1: 0, 2: 0}
-                for score in rounds[last_round]:
-                    player = Player.query.get(score.player_id)
-                    team_scores_after[player.team] += score.points
-                
-                # 判断是否翻盘
-                if (team_scores_before[1] < team_scores_before[2] and 
-                    team_scores_after[1] > team_scores_after[2]):
-                    for player in players:
-                        if player.team == 1:
-                            player_stats[player.name]['comebacks'] += 1
-                elif (team_scores_before[2] < team_scores_before[1] and 
-                      team_scores_after[2] > team_scores_after[1]):
-                    for player in players:
-                        if player.team == 2:
-                            player_stats[player.name]['comebacks'] += 1
+            # 单轮最大翻盘
+            for prev_round, curr_round in zip(timeline, timeline[1:]):
+                if round_numbers[prev_round] != round_numbers[curr_round] - 1:
+                    continue
+                diff_prev = abs(team1_points[prev_round] - team2_points[prev_round])
+                diff_curr = abs(team1_points[curr_round] - team2_points[curr_round])
+                comeback = abs(diff_curr - diff_prev)
+                if comeback > max_comeback:
+                    max_comeback = comeback
+                    max_comeback_match = m
+        
+        # 最激烈 / 最悬殊比赛
+        diff = abs(leads[timeline[-1]]) if timeline else 0
+        if diff < min_diff:
+            min_diff = diff
+            closest_match = m
+        if diff > max_diff:
+            max_diff = diff
+            most_lopsided_match = m
+    
+    def match_record(m):
+        return snapshot.match(m) if m is not None else None
+    
+    unique_players = len(names)
+    monthly_data = [{'month': f'{m}月', 'count': monthly_distribution.get(m, 0)} for m in range(1, 13)]
+    top_locations = location_counter.most_common(3)  # 地点热度 TOP3
+    earliest_match, latest_match = snapshot.match(earliest), snapshot.match(latest)
+    earliest_players, latest_players = snapshot.players(earliest), snapshot.players(latest)
+    max_score_match = match_record(max_score_match)
+    max_comeback_match = match_record(max_comeback_match)
+    closest_match = match_record(closest_match)
+    most_lopsided_match = match_record(most_lopsided_match)
+    
+    def with_name(item):
+        # 将 (person_id, stats) 转为模板使用的 (姓名, stats)
+        return (names[item[0]], item[1]) if item else None
     
     # 年度积分王
-    top_scorer = max(player_stats.items(), key=lambda x: x[1]['total_score']) if player_stats else None
+    top_scorer = with_name(max(player_stats.items(), key=lambda x: x[1]['total_score'])) if player_stats else None
     
     # 年度胜率王（最少10场）
-    win_rate_candidates = [(name, stats) for name, stats in player_stats.items() if stats['matches'] >= 10]
-    top_win_rate = max(win_rate_candidates, 
-                      key=lambda x: x[1]['wins'] / x[1]['matches']) if win_rate_candidates else None
+    win_rate_candidates = [(person_id, stats) for person_id, stats in player_stats.items() if stats['matches'] >= 10]
+    top_win_rate = with_name(max(win_rate_candidates, 
+                                 key=lambda x: x[1]['wins'] / x[1]['matches'])) if win_rate_candidates else None
     
     # 铁人奖（参赛最多）
-    iron_man = max(player_stats.items(), key=lambda x: x[1]['matches']) if player_stats else None
+    iron_man = with_name(max(player_stats.items(), key=lambda x: x[1]['matches'])) if player_stats else None
+    
+    # === 搭档/对手矩阵 ===
+    # 选手按 player_stats 的插入顺序编号，矩阵 [i, j] 为选手 i 与选手 j 的两两统计
+    person_ids = list(player_stats.keys())
+    person_index = {person_id: i for i, person_id in enumerate(person_ids)}
+    together, together_wins, against = pair_stats_kernel(
+        [(m, person_index[person_id], team) for m, person_id, team in participations],
+        winning_teams, len(person_ids))
+    together_rate = np.divide(together_wins, together, out=np.zeros(together.shape), where=together > 0)
+    person_matches = np.array([player_stats[person_id]['matches'] for person_id in person_ids])
+    person_wins = np.array([player_stats[person_id]['wins'] for person_id in person_ids])
+    overall_rate = np.divide(person_wins, person_matches, out=np.zeros(len(person_ids)), where=person_matches > 0)
+    
+    def pair_name(i, j):
+        return names[person_ids[i]], names[person_ids[j]]
     
     # 最佳搭档（同队胜率最高，最少10场）
-    best_partners = []
-    for name, stats in player_stats.items():
-        for teammate, team_stats in stats['teammates'].items():
-            if team_stats['matches'] >= 10:
-                win_rate = team_stats['wins'] / team_stats['matches']
-                best_partners.append((name, teammate, team_stats['matches'], team_stats['wins'], win_rate))
-    best_partners = sorted(best_partners, key=lambda x: x[4], reverse=True)[:3]
+    rows, cols = np.nonzero(together >= 10)
+    order = np.argsort(-together_rate[rows, cols], kind='stable')[:3]
+    best_partners = [pair_name(i, j) + (int(together[i, j]), int(together_wins[i, j]), float(together_rate[i, j]))
+                     for i, j in zip(rows[order], cols[order])]
     
     # === 趣味数据 ===
     # 头名收割机
-    first_place_king = max(player_stats.items(), 
-                          key=lambda x: x[1]['first_place']) if player_stats else None
+    first_place_king = with_name(max(player_stats.items(), 
+                                     key=lambda x: x[1]['first_place'])) if player_stats else None
     
     # 稳定达人（名次方差最小，最少10场）
-    stable_candidates = [(name, stats) for name, stats in player_stats.items() 
-                        if stats['matches'] >= 10 and len(stats['ranks']) > 0]
+    def rank_variance(stats):
+        count = stats['rank_count']
+        return (count * stats['rank_square_sum'] - stats['rank_sum'] ** 2) / (count * count)
+    
+    stable_candidates = [(person_id, stats) for person_id, stats in player_stats.items() 
+                        if stats['matches'] >= 10 and stats['rank_count'] > 0]
     stable_player = None
     if stable_candidates:
-        stable_player = min(stable_candidates, 
-                          key=lambda x: np.var(x[1]['ranks']))
+        stable_player = with_name(min(stable_candidates, key=lambda x: rank_variance(x[1])))
     
     # 大心脏选手（翻盘次数最多）
-    comeback_king = max(player_stats.items(), 
-                       key=lambda x: x[1]['comebacks']) if player_stats else None
+    comeback_king = with_name(max(player_stats.items(), 
+                                  key=lambda x: x[1]['comebacks'])) if player_stats else None
     
     # 陪跑达人（参赛多但胜率最低，最少10场）
-    runner_up_candidates = [(name, stats) for name, stats in player_stats.items() 
+    runner_up_candidates = [(person_id, stats) for person_id, stats in player_stats.items() 
                            if stats['matches'] >= 10]
     runner_up = None
     if runner_up_candidates:
-        runner_up = min(runner_up_candidates, 
-                       key=lambda x: x[1]['wins'] / x[1]['matches'])
+        runner_up = with_name(min(runner_up_candidates, 
+                                  key=lambda x: x[1]['wins'] / x[1]['matches']))
     
     # === 新增趣味统计 ===
+    # 和TA搭档时队友胜率相对队友总体胜率的变化，按队友（至少合作5场）取平均
+    teammate_mask = together >= 5
+    teammate_counts = teammate_mask.sum(axis=1)
+    boost = (together_rate - overall_rate[np.newaxis, :]) * teammate_mask
+    avg_boost = np.divide(boost.sum(axis=1), teammate_counts, out=np.zeros(len(person_ids)), where=teammate_counts > 0)
+    charm_candidates = (person_matches >= 10) & (teammate_counts > 0)
+    
     # 🎲 人形锦鲤（队友buff最强 - 和TA搭档，队友胜率提升最多）
     lucky_charm = None
-    lucky_charm_boost = 0
-    for name, stats in player_stats.items():
-        if stats['matches'] >= 10:
-            # 计算所有队友的平均胜率提升
-            teammate_boosts = []
-            for teammate, team_stats in stats['teammates'].items():
-                if team_stats['matches'] >= 5:  # 至少合作5场
-                    # 和该选手搭档的胜率
-                    together_win_rate = team_stats['wins'] / team_stats['matches']
-                    # 该队友的总体胜率
-                    teammate_overall_win_rate = player_stats[teammate]['wins'] / player_stats[teammate]['matches'] if player_stats[teammate]['matches'] > 0 else 0
-                    boost = together_win_rate - teammate_overall_win_rate
-                    teammate_boosts.append(boost)
-            
-            if teammate_boosts:
-                avg_boost = sum(teammate_boosts) / len(teammate_boosts)
-                if avg_boost > lucky_charm_boost:
-                    lucky_charm_boost = avg_boost
-                    lucky_charm = (name, avg_boost, stats['matches'])
+    candidates = np.flatnonzero(charm_candidates & (avg_boost > 0))
+    if len(candidates):
+        i = candidates[np.argmax(avg_boost[candidates])]
+        lucky_charm = (names[person_ids[i]], float(avg_boost[i]), int(person_matches[i]))
     
     # ☠️ 队友克星（和TA搭档，队友胜率降低最多）
     bad_luck_charm = None
-    bad_luck_debuff = 0
-    for name, stats in player_stats.items():
-        if stats['matches'] >= 10:
-            teammate_debuffs = []
-            for teammate, team_stats in stats['teammates'].items():
-                if team_stats['matches'] >= 5:
-                    together_win_rate = team_stats['wins'] / team_stats['matches']
-                    teammate_overall_win_rate = player_stats[teammate]['wins'] / player_stats[teammate]['matches'] if player_stats[teammate]['matches'] > 0 else 0
-                    debuff = together_win_rate - teammate_overall_win_rate
-                    teammate_debuffs.append(debuff)
-            
-            if teammate_debuffs:
-                avg_debuff = sum(teammate_debuffs) / len(teammate_debuffs)
-                if avg_debuff < bad_luck_debuff:
-                    bad_luck_debuff = avg_debuff
-                    bad_luck_charm = (name, avg_debuff, stats['matches'])
+    candidates = np.flatnonzero(charm_candidates & (avg_boost < 0))
+    if len(candidates):
+        i = candidates[np.argmin(avg_boost[candidates])]
+        bad_luck_charm = (names[person_ids[i]], float(avg_boost[i]), int(person_matches[i]))
     
     # 🌪️ 过山车玩家（单场比赛名次波动最大）
     rollercoaster_player = None
     max_rank_swing = 0
-    for name, stats in player_stats.items():
+    for person_id, stats in player_stats.items():
         if stats['matches'] >= 10 and stats['match_rank_ranges']:
             # 计算平均单场名次波动
             avg_swing = sum(stats['match_rank_ranges']) / len(stats['match_rank_ranges'])
             max_swing_in_match = max(stats['match_rank_ranges'])
             if max_swing_in_match > max_rank_swing:
                 max_rank_swing = max_swing_in_match
-                rollercoaster_player = (name, max_swing_in_match, avg_swing, stats['matches'])
+                rollercoaster_player = (names[person_id], max_swing_in_match, avg_swing, stats['matches'])
     
     # === 对战记录 ===
     # 最强宿敌（对战次数最多，最少10场）
-    rivalries = []
-    processed_pairs = set()
-    for name, stats in player_stats.items():
-        for opponent, opp_stats in stats['opponents'].items():
-            pair = tuple(sorted([name, opponent]))
-            if pair not in processed_pairs and opp_stats['matches'] >= 10:
-                rivalries.append((name, opponent, opp_stats['matches']))
-                processed_pairs.add(pair)
-    strongest_rivalry = max(rivalries, key=lambda x: x[2]) if rivalries else None
+    rows, cols = np.nonzero(np.triu(against >= 10, k=1))
+    strongest_rivalry = None
+    if len(rows):
+        k = np.argmax(against[rows, cols])
+        strongest_rivalry = pair_name(rows[k], cols[k]) + (int(against[rows[k], cols[k]]),)
     
     # 最佳拍档（搭档次数最多，不考虑胜率）
-    most_frequent_partners = []
-    processed_teammate_pairs = set()
-    for name, stats in player_stats.items():
-        for teammate, team_stats in stats['teammates'].items():
-            pair = tuple(sorted([name, teammate]))
-            if pair not in processed_teammate_pairs:
-                most_frequent_partners.append((name, teammate, team_stats['matches'], team_stats['wins']))
-                processed_teammate_pairs.add(pair)
-    most_frequent_partners = sorted(most_frequent_partners, key=lambda x: x[2], reverse=True)
-    most_frequent_partner = most_frequent_partners[0] if most_frequent_partners else None
+    rows, cols = np.nonzero(np.triu(together > 0, k=1))
+    most_frequent_partner = None
+    if len(rows):
+        k = np.argmax(together[rows, cols])
+        i, j = rows[k], cols[k]
+        most_frequent_partner = pair_name(i, j) + (int(together[i, j]), int(together_wins[i, j]))
     
     # 黄金搭档 vs 冤家对头
     golden_partner = best_partners[0] if best_partners else None
     
-    worst_partners = []
-    for name, stats in player_stats.items():
-        for teammate, team_stats in stats['teammates'].items():
-            if team_stats['matches'] >= 10:
-                win_rate = team_stats['wins'] / team_stats['matches']
-                worst_partners.append((name, teammate, team_stats['matches'], team_stats['wins'], win_rate))
-    worst_partners = sorted(worst_partners, key=lambda x: x[4])[:3]
+    rows, cols = np.nonzero(together >= 10)
+    order = np.argsort(together_rate[rows, cols], kind='stable')[:3]
+    worst_partners = [pair_name(i, j) + (int(together[i, j]), int(together_wins[i, j]), float(together_rate[i, j]))
+                      for i, j in zip(rows[order], cols[order])]
     worst_partner = worst_partners[0] if worst_partners else None
     
-    # === 年度之最 ===
-    # 单场最高分
-    max_single_score = 0
-    max_score_player = None
-    max_score_match = None
-    for match in finished_matches:
-        players = Player.query.filter_by(match_id=match.id).all()
-        for player in players:
-            scores = RoundScore.query.filter_by(match_id=match.id, player_id=player.id).all()
-            total = sum(s.points for s in scores)
-            if total > max_single_score:
-                max_single_score = total
-                max_score_player = player.name
-                max_score_match = match
-    
-    # 单轮最大翻盘
-    max_comeback = 0
-    max_comeback_match = None
-    for match in finished_matches:
-        rounds = defaultdict(list)
-        round_scores = RoundScore.query.filter_by(match_id=match.id).all()
-        for score in round_scores:
-            rounds[score.round_number].append(score)
-        
-        if len(rounds) >= 2:
-            for round_num in range(2, max(rounds.keys()) + 1):
-                prev_round = round_num - 1
-                if prev_round in rounds and round_num in rounds:
-                    # 计算前一轮队伍分差
-                    team_scores_prev = {1: 0, 2: 0}
-                    for score in rounds[prev_round]:
-                        player = Player.query.get(score.player_id)
-                        team_scores_prev[player.team] += score.points
-                    
-                    # 计算当前轮队伍分差
-                    team_scores_curr = {1: 0, 2: 0}
-                    for score in rounds[round_num]:
-                        player = Player.query.get(score.player_id)
-                        team_scores_curr[player.team] += score.points
-                    
-                    diff_prev = abs(team_scores_prev[1] - team_scores_prev[2])
-                    diff_curr = abs(team_scores_curr[1] - team_scores_curr[2])
-                    comeback = abs(diff_curr - diff_prev)
-                    
-                    if comeback > max_comeback:
-                        max_comeback = comeback
-                        max_comeback_match = match
-    
-    # 最激烈比赛（分差最小）
-    min_diff = float('inf')
-    closest_match = None
-    for match in finished_matches:
-        players = Player.query.filter_by(match_id=match.id).all()
-        team_scores = {1: 0, 2: 0}
-        for player in players:
-            scores = RoundScore.query.filter_by(match_id=match.id, player_id=player.id).all()
-            team_scores[player.team] += sum(s.points for s in scores)
-        
-        diff = abs(team_scores[1] - team_scores[2])
-        if diff < min_diff:
-            min_diff = diff
-            closest_match = match
-    
-    # 最悬殊比赛（分差最大）
-    max_diff = 0
-    most_lopsided_match = None
-    for match in finished_matches:
-        players = Player.query.filter_by(match_id=match.id).all()
-        team_scores = {1: 0, 2: 0}
-        for player in players:
-            scores = RoundScore.query.filter_by(match_id=match.id, player_id=player.id).all()
-            team_scores[player.team] += sum(s.points for s in scores)
-        
-        diff = abs(team_scores[1] - team_scores[2])
-        if diff > max_diff:
-            max_diff = diff
-            most_lopsided_match = match
-    
     # 收益/亏损统计
-    profit_rankings = sorted([(name, stats['profit']) for name, stats in player_stats.items()],
+    profit_rankings = sorted([(names[person_id], stats['profit']) for person_id, stats in player_stats.items()],
                             key=lambda x: x[1], reverse=True)
     
     top_profit_maker = profit_rankings[0] if profit_rankings else None
     biggest_loser = profit_rankings[-1] if profit_rankings else None
     
-    return render_template('annual_report.html',
-                         year=year,
-                         no_data=False,
-                         # 基础统计
-                         total_matches=total_matches,
-                         finished_matches_count=len(finished_matches),
-                         total_rounds=total_rounds,
-                         total_participations=total_participations,
-                         unique_players=unique_players,
-                         monthly_data=monthly_data,
-                         top_locations=top_locations,
-                         earliest_match=earliest_match,
-                         latest_match=latest_match,
-                         earliest_players=earliest_players,
-                         latest_players=latest_players,
-                         # 荣誉榜单
-                         top_scorer=top_scorer,
-                         top_win_rate=top_win_rate,
-                         iron_man=iron_man,
-                         best_partners=best_partners[:3],
-                         # 趣味数据
-                         first_place_king=first_place_king,
-                         stable_player=stable_player,
-                         comeback_king=comeback_king,
-                         runner_up=runner_up,
-                         lucky_charm=lucky_charm,
-                         bad_luck_charm=bad_luck_charm,
-                         rollercoaster_player=rollercoaster_player,
-                         # 对战记录
-                         strongest_rivalry=strongest_rivalry,
-                         most_frequent_partner=most_frequent_partner,
-                         golden_partner=golden_partner,
-                         worst_partner=worst_partner,
-                         # 年度之最
-                         max_score_player=max_score_player,
-                         max_single_score=max_single_score,
-                         max_score_match=max_score_match,
-                         max_comeback=max_comeback,
-                         max_comeback_match=max_comeback_match,
-                         closest_match=closest_match,
-                         min_diff=min_diff,
-                         most_lopsided_match=most_lopsided_match,
-                         max_diff=max_diff,
-                         # 收益亏损
-                         top_profit_maker=top_profit_maker,
-                         biggest_loser=biggest_loser,
-                         profit_rankings=profit_rankings)
+    return dict(year=year,
+                no_data=False,
+                # 基础统计
+                total_matches=total_matches,
+                finished_matches_count=finished_matches_count,
+                total_rounds=total_rounds,
+                total_participations=total_participations,
+                unique_players=unique_players,
+                monthly_data=monthly_data,
+                top_locations=top_locations,
+                earliest_match=earliest_match,
+                latest_match=latest_match,
+                earliest_players=earliest_players,
+                latest_players=latest_players,
+                # 荣誉榜单
+                top_scorer=top_scorer,
+                top_win_rate=top_win_rate,
+                iron_man=iron_man,
+                best_partners=best_partners[:3],
+                # 趣味数据
+                first_place_king=first_place_king,
+                stable_player=stable_player,
+                comeback_king=comeback_king,
+                runner_up=runner_up,
+                lucky_charm=lucky_charm,
+                bad_luck_charm=bad_luck_charm,
+                rollercoaster_player=rollercoaster_player,
+                # 对战记录
+                strongest_rivalry=strongest_rivalry,
+                most_frequent_partner=most_frequent_partner,
+                golden_partner=golden_partner,
+                worst_partner=worst_partner,
+                # 年度之最
+                max_score_player=max_score_player,
+                max_single_score=max_single_score,
+                max_score_match=max_score_match,
+                max_comeback=max_comeback,
+                max_comeback_match=max_comeback_match,
+                closest_match=closest_match,
+                min_diff=min_diff,
+                most_lopsided_match=most_lopsided_match,
+                max_diff=max_diff,
+                # 收益亏损
+                top_profit_maker=top_profit_maker,
+                biggest_loser=biggest_loser,
+                profit_rankings=profit_rankings)
+
+
+# === 多年度 / 生涯报告 ===
+ROLLUP_PLAYER_FIELDS = ['matches', 'wins', 'total_score', 'first_places', 'rank_count', 'rank_sum', 'rank_square_sum', 'profit']
+ROLLUP_PAIR_FIELDS = ['together', 'together_wins', 'against']
+ROLLUP_YEAR_FIELDS = ['matches', 'finished_matches', 'rounds', 'participations']
+
+def year_fingerprint(year):
+    # 场次、比赛 id 之和、轮数之和与已结束场次，任何影响年度统计的写入都会改变其中至少一项
+    row = db.session.query(
+        db.func.count(Match.id),
+        db.func.coalesce(db.func.sum(Match.id), 0),
+        db.func.coalesce(db.func.sum(MatchResult.rounds), 0),
+        db.func.coalesce(db.func.sum(db.case((Match.status == 'finished', 1), else_=0)), 0)
+    ).outerjoin(MatchResult, MatchResult.match_id == Match.id) \
+     .filter(year_range(year)).one()
+    return '-'.join(str(value) for value in row)
+
+def compute_year_rollup(year):
+    # 用分组聚合从汇总表和成绩表计算一年的选手与两人组合统计：
+    # {'year', 'matches', ..., 'players': {person_id: {...}}, 'pairs': {(person1_id, person2_id): {...}}}
+    finished = db.and_(year_range(year), Match.status == 'finished')
+    matches, finished_matches, rounds = db.session.query(
+        db.func.count(Match.id),
+        db.func.coalesce(db.func.sum(db.case((Match.status == 'finished', 1), else_=0)), 0),
+        db.func.coalesce(db.func.sum(MatchResult.rounds), 0)
+    ).outerjoin(MatchResult, MatchResult.match_id == Match.id) \
+     .filter(year_range(year)).one()
+    participations = db.session.query(db.func.count(Player.id)) \
+        .join(Match, Match.id == Player.match_id) \
+        .filter(year_range(year)).scalar()
+    rollup = {'year': year, 'matches': matches, 'finished_matches': finished_matches, 'rounds': rounds,
+              'participations': participations, 'players': {}, 'pairs': {}}
+
+    won = db.case((MatchResult.winning_team.is_(None), 1), (MatchResult.winning_team == Player.team, 1), else_=0)
+    profit = db.case((MatchResult.winning_team.is_(None), 0),
+                     (MatchResult.winning_team == Player.team, MatchResult.profit_diff),
+                     else_=-MatchResult.profit_diff)
+    player_rows = db.session.query(
+        Player.person_id,
+        db.func.count(Player.id),
+        db.func.sum(won),
+        db.func.coalesce(db.func.sum(PlayerMatchResult.total_score), 0),
+        db.func.coalesce(db.func.sum(PlayerMatchResult.first_places), 0),
+        db.func.sum(profit)
+    ).join(Match, Match.id == Player.match_id) \
+     .join(MatchResult, MatchResult.match_id == Match.id) \
+     .outerjoin(PlayerMatchResult, PlayerMatchResult.player_id == Player.id) \
+     .filter(finished) \
+     .group_by(Player.person_id).all()
+    for person_id, count, wins, total_score, first_places, person_profit in player_rows:
+        rollup['players'][person_id] = {'matches': count, 'wins': wins, 'total_score': total_score,
+                                        'first_places': first_places, 'rank_count': 0, 'rank_sum': 0,
+                                        'rank_square_sum': 0, 'profit': person_profit}
+
+    rank_rows = db.session.query(
+        Player.person_id,
+        db.func.count(RoundScore.id),
+        db.func.sum(RoundScore.rank),
+        db.func.sum(RoundScore.rank * RoundScore.rank)
+    ).join(Player, Player.id == RoundScore.player_id) \
+     .join(Match, Match.id == RoundScore.match_id) \
+     .filter(finished) \
+     .group_by(Player.person_id).all()
+    for person_id, count, rank_sum, rank_square_sum in rank_rows:
+        if person_id in rollup['players']:
+            rollup['players'][person_id].update(rank_count=count, rank_sum=rank_sum, rank_square_sum=rank_square_sum)
+
+    first, second = aliased(Player), aliased(Player)
+    same_team = first.team == second.team
+    pair_rows = db.session.query(
+        first.person_id,
+        second.person_id,
+        db.func.sum(db.case((same_team, 1), else_=0)),
+        db.func.sum(db.case((db.and_(same_team, MatchResult.winning_team == first.team), 1), else_=0)),
+        db.func.sum(db.case((same_team, 0), else_=1))
+    ).join(second, db.and_(second.match_id == first.match_id, second.person_id > first.person_id)) \
+     .join(Match, Match.id == first.match_id) \
+     .join(MatchResult, MatchResult.match_id == Match.id) \
+     .filter(finished) \
+     .group_by(first.person_id, second.person_id).all()
+    for person1_id, person2_id, together, together_wins, against in pair_rows:
+        rollup['pairs'][(person1_id, person2_id)] = {'together': together, 'together_wins': together_wins,
+                                                     'against': against}
+    return rollup
+
+def load_year_rollup(stored):
+    rollup = {field: getattr(stored, field) for field in ROLLUP_YEAR_FIELDS}
+    rollup['year'] = stored.year
+    rollup['players'] = {row.person_id: {field: getattr(row, field) for field in ROLLUP_PLAYER_FIELDS}
+                         for row in PlayerYearRollup.query.filter_by(year=stored.year).all()}
+    rollup['pairs'] = {(row.person1_id, row.person2_id): {field: getattr(row, field) for field in ROLLUP_PAIR_FIELDS}
+                       for row in PairYearRollup.query.filter_by(year=stored.year).all()}
+    return rollup
+
+def save_year_rollup(rollup, fingerprint):
+    year = rollup['year']
+    YearRollup.query.filter_by(year=year).delete()
+    PlayerYearRollup.query.filter_by(year=year).delete()
+    PairYearRollup.query.filter_by(year=year).delete()
+    db.session.add(YearRollup(year=year, fingerprint=fingerprint, computed_at=datetime.datetime.now(),
+                              **{field: rollup[field] for field in ROLLUP_YEAR_FIELDS}))
+    if rollup['players']:
+        db.session.execute(PlayerYearRollup.__table__.insert(),
+                           [dict(stats, year=year, person_id=person_id) for person_id, stats in rollup['players'].items()])
+    if rollup['pairs']:
+        db.session.execute(PairYearRollup.__table__.insert(),
+                           [dict(stats, year=year, person1_id=person1_id, person2_id=person2_id)
+                            for (person1_id, person2_id), stats in rollup['pairs'].items()])
+    try:
+        db.session.commit()
+    except (IntegrityError, OperationalError):
+        db.session.rollback()  # 其他请求同时保存了同一年，直接使用本次计算结果
+
+def year_rollup(year):
+    # 当年（及以后）的数据仍在变化，实时计算；往年读取保存的汇总，指纹不一致时重新计算并保存
+    if year >= datetime.date.today().year:
+        return compute_year_rollup(year)
+    fingerprint = year_fingerprint(year)
+    stored = db.session.get(YearRollup, year)
+    if stored is not None and stored.fingerprint == fingerprint:
+        return load_year_rollup(stored)
+    rollup = compute_year_rollup(year)
+    save_year_rollup(rollup, fingerprint)
+    return rollup
+
+def merge_rollups(rollups):
+    players = defaultdict(lambda: dict.fromkeys(ROLLUP_PLAYER_FIELDS, 0))
+    pairs = defaultdict(lambda: dict.fromkeys(ROLLUP_PAIR_FIELDS, 0))
+    for rollup in rollups:
+        for person_id, stats in rollup['players'].items():
+            for field in ROLLUP_PLAYER_FIELDS:
+                players[person_id][field] += stats[field]
+        for pair, stats in rollup['pairs'].items():
+            for field in ROLLUP_PAIR_FIELDS:
+                pairs[pair][field] += stats[field]
+    return players, pairs
+
+def player_summary(name, stats):
+    # 由可累加的计数得到胜率、平均名次与名次方差
+    summary = dict(stats, name=name)
+    summary['win_rate'] = stats['wins'] / stats['matches'] if stats['matches'] else 0
+    if stats['rank_count']:
+        mean = stats['rank_sum'] / stats['rank_count']
+        summary['avg_rank'] = mean
+        summary['rank_variance'] = max(stats['rank_square_sum'] / stats['rank_count'] - mean * mean, 0)
+    else:
+        summary['avg_rank'] = summary['rank_variance'] = None
+    return summary
+
+def compute_multi_year_report(start_year, end_year):
+    rollups = [year_rollup(year) for year in range(start_year, end_year + 1)]
+    person_ids = {person_id for rollup in rollups for person_id in rollup['players']} | \
+        {person_id for rollup in rollups for pair in rollup['pairs'] for person_id in pair}
+    names = dict(db.session.query(Person.id, Person.name).filter(Person.id.in_(person_ids)).all()) if person_ids else {}
+    return rollup_report(start_year, end_year, rollups, names)
+
+def rollup_report(start_year, end_year, rollups, names):
+    # 由逐年汇总生成报告；names 为汇总中选手键到姓名的映射
+    players, pairs = merge_rollups(rollups)
+    if not any(rollup['matches'] for rollup in rollups):
+        return {'start_year': start_year, 'end_year': end_year, 'no_data': True}
+
+    # 逐年趋势
+    year_rows = []
+    for rollup in rollups:
+        row = {field: rollup[field] for field in ROLLUP_YEAR_FIELDS}
+        row['year'] = rollup['year']
+        row['players'] = len(rollup['players'])
+        year_rows.append(row)
+
+    # 生涯统计（按总积分排序）
+    career = sorted((player_summary(names[person_id], stats) for person_id, stats in players.items()),
+                    key=lambda x: x['total_score'], reverse=True)
+    qualified = [summary for summary in career if summary['matches'] >= 10]
+
+    # 出场最多的选手逐年表现
+    trend_players = sorted(players, key=lambda person_id: players[person_id]['matches'], reverse=True)[:10]
+    player_trends = [(names[person_id],
+                      [player_summary(names[person_id], rollup['players'][person_id])
+                       if person_id in rollup['players'] else None for rollup in rollups])
+                     for person_id in trend_players]
+
+    pair_list = [(names[person1_id], names[person2_id], stats) for (person1_id, person2_id), stats in pairs.items()]
+    best_partners = sorted((pair for pair in pair_list if pair[2]['together'] >= 10),
+                           key=lambda x: x[2]['together_wins'] / x[2]['together'], reverse=True)[:5]
+    frequent_partners = sorted((pair for pair in pair_list if pair[2]['together']),
+                               key=lambda x: x[2]['together'], reverse=True)[:5]
+    rivalries = sorted((pair for pair in pair_list if pair[2]['against']),
+                       key=lambda x: x[2]['against'], reverse=True)[:5]
+
+    return dict(start_year=start_year,
+                end_year=end_year,
+                no_data=False,
+                live_year=datetime.date.today().year if start_year <= datetime.date.today().year <= end_year else None,
+                year_rows=year_rows,
+                total_matches=sum(row['matches'] for row in year_rows),
+                finished_matches_count=sum(row['finished_matches'] for row in year_rows),
+                total_rounds=sum(row['rounds'] for row in year_rows),
+                unique_players=len(players),
+                career=career,
+                top_scorer=career[0] if career else None,
+                iron_man=max(career, key=lambda x: x['matches']) if career else None,
+                top_win_rate=max(qualified, key=lambda x: x['win_rate']) if qualified else None,
+                top_profit_maker=max(career, key=lambda x: x['profit']) if career else None,
+                stable_player=min((x for x in qualified if x['rank_count']), key=lambda x: x['rank_variance'], default=None),
+                player_trends=player_trends,
+                best_partners=best_partners,
+                frequent_partners=frequent_partners,
+                rivalries=rivalries)
+
+def match_time_range():
+    return db.session.query(db.func.min(Match.time), db.func.max(Match.time)).one()
+
+def requested_years(first_time, last_time):
+    # 默认统计全部年份；?start=2023&end=2025 指定区间。年份限制在 REPORT_YEARS 之内（比赛时间本身也可能超出），
+    # 年数不超过 REPORT_MAX_YEARS。没有比赛时调用方直接显示无数据页面，不逐年计算
+    current_year = datetime.date.today().year
+    start_year = request.args.get('start', first_time.year if first_time else current_year, type=int)
+    end_year = request.args.get('end', last_time.year if last_time else current_year, type=int)
+    if start_year > end_year:
+        start_year, end_year = end_year, start_year
+    if first_time:
+        # 只统计有比赛的年份范围，避免过大的区间逐年生成空汇总
+        start_year = min(max(start_year, first_time.year), last_time.year)
+        end_year = max(min(end_year, last_time.year), start_year)
+    start_year = min(max(start_year, REPORT_YEARS[0]), REPORT_YEARS[-1])
+    end_year = min(max(end_year, REPORT_YEARS[0]), REPORT_YEARS[-1])
+    return max(start_year, end_year - app.config['REPORT_MAX_YEARS'] + 1), end_year
+
+@app.route('/multi_year_report')
+def multi_year_report():
+    first_time, last_time = match_time_range()
+    start_year, end_year = requested_years(first_time, last_time)
+    if first_time is None:
+        return render_template('multi_year_report.html', start_year=start_year, end_year=end_year, no_data=True)
+    if app.config['REPORT_BACKGROUND']:
+        fingerprint = '|'.join(year_fingerprint(year) for year in range(start_year, end_year + 1))
+        return background_report(f'multi_year:{start_year}-{end_year}', fingerprint, 'multi_year_report.html',
+                                 compute_multi_year_report, start_year, end_year)
+    return render_template('multi_year_report.html', **compute_multi_year_report(start_year, end_year))
+
+# === 后台报告任务 ===
+report_executor = None
+report_executor_lock = threading.Lock()
+
+def get_report_executor():
+    global report_executor
+    with report_executor_lock:
+        if report_executor is None:
+            report_executor = ThreadPoolExecutor(max_workers=app.config['REPORT_WORKERS'], thread_name_prefix='report')
+        return report_executor
+
+def run_report_job(job_id, club, script_root, template, compute, args):
+    # 在提交任务的请求所属的俱乐部中计算；渲染时使用原请求的 SCRIPT_NAME，页面中的链接与直接访问时相同
+    with app.app_context():
+        g.club = club
+        job = db.session.get(ReportJob, job_id)
+        job.status = 'running'
+        db.session.commit()
+        try:
+            context = compute(*args)
+            with app.test_request_context(environ_overrides={'SCRIPT_NAME': script_root}):
+                html = render_template(template, **context)
+        except Exception as e:
+            app.logger.exception('报告任务 %s 失败', job.report_key)
+            db.session.rollback()
+            job.status, job.error = 'failed', str(e)
+        else:
+            job.status, job.html = 'done', html
+            # 同一报告只保留最新的结果
+            ReportJob.query.filter(ReportJob.report_key == job.report_key, ReportJob.id != job.id,
+                                   ReportJob.status.in_(['done', 'failed'])).delete()
+        job.finished_at = datetime.datetime.now()
+        db.session.commit()
+
+def submit_report_job(report_key, fingerprint, template, compute, *args):
+    # 相同报告、相同数据指纹已有未超时的任务时直接复用，否则提交新任务；返回任务
+    stale = datetime.datetime.now() - datetime.timedelta(seconds=app.config['REPORT_JOB_TIMEOUT'])
+    job = ReportJob.query.filter(ReportJob.report_key == report_key, ReportJob.fingerprint == fingerprint,
+                                 db.or_(ReportJob.status == 'done',
+                                        db.and_(ReportJob.status.in_(['pending', 'running']), ReportJob.created_at > stale))) \
+        .order_by(ReportJob.created_at.desc()).first()
+    if job is not None:
+        return job
+    job = ReportJob(id=uuid.uuid4().hex, report_key=report_key, fingerprint=fingerprint, status='pending',
+                    created_at=datetime.datetime.now())
+    db.session.add(job)
+    db.session.commit()
+    get_report_executor().submit(run_report_job, job.id, current_club(),
+                                 request.script_root if has_request_context() else '', template, compute, args)
+    return job
+
+def background_report(report_key, fingerprint, template, compute, *args):
+    job = submit_report_job(report_key, fingerprint, template, compute, *args)
+    if job.status == 'done':
+        return job.html
+    return render_template('report_pending.html', job=job), 202
+
+@app.route('/report_jobs/<job_id>')
+def report_job_status(job_id):
+    job = db.get_or_404(ReportJob, job_id)
+    return jsonify({'id': job.id, 'report': job.report_key, 'status': job.status, 'error': job.error,
+                    'created_at': job.created_at.isoformat() if job.created_at else None,
+                    'finished_at': job.finished_at.isoformat() if job.finished_at else None})
+
+# === 多俱乐部 ===
+# 设置 CLUB_DIRECTORY 后每个俱乐部使用目录下单独的 <俱乐部>.db，一个俱乐部录入成绩时的写锁不影响其他俱乐部。
+# 请求通过 URL 前缀 /c/<俱乐部>/... 或子域名 <俱乐部>.CLUB_DOMAIN 选择俱乐部，其余请求仍使用默认数据库
+CLUB_NAME = re.compile(r'[a-z0-9][a-z0-9_-]{0,49}')
+
+class ClubRegistry:
+    # 各俱乐部数据库的引擎，第一次使用时创建并执行 init_database。会话仍是每个应用上下文一个，
+    # 由 ClubSession.get_bind 按 g.club 取用这里的引擎
+    def __init__(self):
+        self.engines = {}
+        self._initializing = {}
+        self._lock = threading.RLock()
+
+    def directory(self):
+        return os.path.join(app.instance_path, app.config['CLUB_DIRECTORY'])
+
+    def path(self, club):
+        return os.path.join(self.directory(), f'{club}.db')
+
+    def clubs(self):
+        if not app.config['CLUB_DIRECTORY'] or not os.path.isdir(self.directory()):
+            return []
+        return sorted(name[:-3] for name in os.listdir(self.directory())
+                      if name.endswith('.db') and CLUB_NAME.fullmatch(name[:-3]))
+
+    def exists(self, club):
+        return bool(app.config['CLUB_DIRECTORY'] and CLUB_NAME.fullmatch(club) and os.path.exists(self.path(club)))
+
+    def engine(self, club):
+        engine = self.engines.get(club)
+        if engine is not None:
+            return engine
+        with self._lock:  # 其他线程等待初始化完成；初始化过程中（同一线程）的查询直接使用正在初始化的引擎
+            engine = self.engines.get(club) or self._initializing.get(club)
+            if engine is not None:
+                return engine
+            os.makedirs(self.directory(), exist_ok=True)
+            engine = create_engine(f'sqlite:///{self.path(club)}', **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+            self._initializing[club] = engine
+            try:
+                with app.app_context():
+                    g.club = club
+                    init_database()
+            finally:
+                del self._initializing[club]
+            self.engines[club] = engine
+            return engine
+
+club_registry = ClubRegistry()
+
+class ClubMiddleware:
+    # 从 URL 前缀或子域名识别俱乐部写入 environ['guandan.club']。前缀从 PATH_INFO 移到 SCRIPT_NAME，
+    # 路由不变，url_for 生成的链接自动带上前缀
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        environ['guandan.club_root'] = environ.get('SCRIPT_NAME', '')
+        if app.config['CLUB_DIRECTORY']:
+            parts = environ.get('PATH_INFO', '').split('/', 3)  # ['', 'c', 俱乐部, 其余路径]
+            if len(parts) >= 3 and parts[1] == 'c':
+                environ['guandan.club'] = parts[2]
+                environ['SCRIPT_NAME'] = environ['guandan.club_root'] + f'/c/{parts[2]}'
+                environ['PATH_INFO'] = '/' + (parts[3] if len(parts) > 3 else '')
+            elif app.config['CLUB_DOMAIN']:
+                host = environ.get('HTTP_HOST', '').split(':')[0].lower()
+                suffix = '.' + app.config['CLUB_DOMAIN']
+                if host.endswith(suffix):
+                    environ['guandan.club'] = host[:-len(suffix)]
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = ClubMiddleware(app.wsgi_app)
+
+@app.before_request
+def select_club():
+    club = request.environ.get('guandan.club')
+    if club is not None and not club_registry.exists(club):
+        abort(404)
+    g.club = club
+
+@app.cli.command('create-club')
+@click.argument('name')
+def create_club_command(name):
+    if not app.config['CLUB_DIRECTORY']:
+        raise click.ClickException('请先通过 GUANDAN_CLUB_DIRECTORY 设置俱乐部数据库目录')
+    if not CLUB_NAME.fullmatch(name):
+        raise click.ClickException('俱乐部名只能包含小写字母、数字、- 和 _')
+    if club_registry.exists(name):
+        raise click.ClickException(f'俱乐部 {name} 已存在')
+    club_registry.engine(name)
+    click.echo(f'已创建俱乐部 {name}：{club_registry.path(name)}')
+
+# 跨俱乐部的只读统计：在线程池中并行查询各俱乐部数据库，得到可累加的部分结果后按姓名合并
+# （各俱乐部的 person_id 互不相通，同名视为同一人）。SQLite 执行查询时释放 GIL，各库的查询可以同时进行
+club_executor = None
+club_executor_lock = threading.Lock()
+
+def get_club_executor():
+    global club_executor
+    with club_executor_lock:
+        if club_executor is None:
+            club_executor = ThreadPoolExecutor(max_workers=app.config['CLUB_FANOUT_WORKERS'], thread_name_prefix='club')
+        return club_executor
+
+def run_in_club(club, function, args):
+    with app.app_context():
+        g.club = club
+        return function(*args)
+
+def for_each_club(function, *args):
+    # 在每个俱乐部的数据库上并行执行 function，按俱乐部名的顺序返回 [(俱乐部, 结果)]
+    clubs = club_registry.clubs()
+    futures = [get_club_executor().submit(run_in_club, club, function, args) for club in clubs]
+    return [(club, future.result()) for club, future in zip(clubs, futures)]
+
+def named_year_rollups(start_year, end_year):
+    # 本俱乐部的逐年汇总，选手与组合改用姓名作键
+    rollups = [year_rollup(year) for year in range(start_year, end_year + 1)]
+    names = dict(db.session.query(Person.id, Person.name).all())
+    for rollup in rollups:
+        rollup['players'] = {names[person_id]: stats for person_id, stats in rollup['players'].items()}
+        rollup['pairs'] = {tuple(sorted((names[person1_id], names[person2_id]))): stats
+                           for (person1_id, person2_id), stats in rollup['pairs'].items()}
+    return rollups
+
+def merge_club_rollups(club_rollups):
+    # 各俱乐部同一年的汇总相加为一份
+    merged = []
+    for rollups in zip(*club_rollups):
+        rollup = {field: sum(part[field] for part in rollups) for field in ROLLUP_YEAR_FIELDS}
+        rollup['year'] = rollups[0]['year']
+        players, pairs = merge_rollups(rollups)
+        rollup['players'], rollup['pairs'] = dict(players), dict(pairs)
+        merged.append(rollup)
+    return merged
+
+def compute_club_report(start_year, end_year):
+    results = for_each_club(named_year_rollups, start_year, end_year)
+    rollups = merge_club_rollups([rollups for _, rollups in results])
+    names = {name: name for rollup in rollups for name in rollup['players']}
+    names.update((name, name) for rollup in rollups for pair in rollup['pairs'] for name in pair)
+    report = rollup_report(start_year, end_year, rollups, names)
+    report['clubs'] = [club for club, _ in results]
+    return report
+
+@app.route('/clubs')
+def clubs():
+    # 全部俱乐部合计的排行榜
+    if not app.config['CLUB_DIRECTORY']:
+        abort(404)
+    results = for_each_club(leaderboard_totals)
+    score_rankings, win_rate_rankings = rank_leaderboards(*merge_leaderboard_totals([totals for _, totals in results]))
+    root = request.environ.get('guandan.club_root', '')
+    return render_template('clubs.html', clubs=[(club, f'{root}/c/{club}/') for club, _ in results],
+                           score_rankings=score_rankings, win_rate_rankings=win_rate_rankings,
+                           current_year=datetime.date.today().year)
+
+@app.route('/clubs/report')
+def club_report():
+    # 全部俱乐部合计的生涯 / 年度报告，参数同 /multi_year_report
+    if not app.config['CLUB_DIRECTORY']:
+        abort(404)
+    results = for_each_club(match_time_range)
+    ranges = [times for _, times in results if times[0] is not None]
+    first_time = min((first for first, _ in ranges), default=None)
+    last_time = max((last for _, last in ranges), default=None)
+    start_year, end_year = requested_years(first_time, last_time)
+    if first_time is None:
+        return render_template('multi_year_report.html', start_year=start_year, end_year=end_year, no_data=True,
+                               clubs=[club for club, _ in results])
+    return render_template('multi_year_report.html', **compute_club_report(start_year, end_year))
 
 
 # # 运行应用
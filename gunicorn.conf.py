@@ -0,0 +1,18 @@
+# gunicorn 配置：多进程 + 每进程多线程（长轮询 / SSE 连接等待期间只占用线程）
+import multiprocessing
+import os
+
+bind = os.environ.get('GUANDAN_BIND', '0.0.0.0:8899')
+workers = int(os.environ.get('GUANDAN_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUANDAN_THREADS', 8))
+timeout = 60
+preload_app = True  # 建表、迁移与汇总补齐只在主进程执行一次
+raw_env = ['GUANDAN_CONFIG=production']
+
+
+def post_fork(server, worker):
+    # 主进程加载应用时建立的数据库连接不能被子进程共用，丢弃后由各子进程重新建立
+    from flask_app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -0,0 +1,56 @@
+# 测试使用临时数据库：flask_app 导入时即初始化数据库，必须在导入前设置 GUANDAN_DATABASE_URI
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+os.environ['GUANDAN_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import flask_app as fa
+
+POINTS = [30, 24, 20, 16, 12, 8, 4, 0, 0, 0, 0, 0]
+
+
+@pytest.fixture
+def client():
+    return fa.app.test_client()
+
+
+@contextmanager
+def count_queries():
+    # 记录期间执行的 (SQL, 参数)
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def create_match(client, player_count=8, time='2025-06-01T20:00'):
+    form = {'player_count': player_count, 'time': time, 'location': '测试'}
+    for i in range(1, player_count + 1):
+        form[f'player_{i}'] = f'选手{i}'
+        form[f'points_{i}'] = POINTS[i - 1]
+    client.post('/create_match', data=form)
+    with fa.app.app_context():
+        match = fa.Match.query.order_by(fa.Match.id.desc()).first()
+        return match.id, [player.id for player in match.players]
+
+
+def round_form(player_ids, round_number=None):
+    data = {'submit_scores': '1'}
+    for rank, player_id in enumerate(player_ids, start=1):
+        data[f'player_{rank}'] = player_id
+    if round_number is not None:
+        data['round_number'] = round_number
+    return data
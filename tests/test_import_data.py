@@ -0,0 +1,24 @@
+# export-data / import-data：导入的比赛不复用已删除比赛的 id，空姓名的选手身份可以导入
+from conftest import create_match, fa
+
+
+def test_import_skips_deleted_match_ids(client, tmp_path):
+    create_match(client, player_count=4)
+    deleted_id, _ = create_match(client, player_count=4)
+    client.post(f'/delete_match/{deleted_id}')
+    with fa.app.app_context():
+        fa.db.session.add(fa.Person(name=''))
+        fa.db.session.commit()
+        existing = {match_id for (match_id,) in fa.db.session.query(fa.Match.id)}
+
+    runner = fa.app.test_cli_runner()
+    exported = runner.invoke(args=['export-data', str(tmp_path)])
+    assert exported.exit_code == 0, exported.output
+    imported = runner.invoke(args=['import-data', str(tmp_path)])
+    assert imported.exit_code == 0, imported.output
+
+    with fa.app.app_context():
+        new_ids = {match_id for (match_id,) in fa.db.session.query(fa.Match.id)} - existing
+        assert len(new_ids) == len(existing)
+        assert min(new_ids) > deleted_id
+        assert fa.check_match_results() == []
@@ -0,0 +1,25 @@
+# 实时比分接口：读取 ETag 之后比赛被删除时返回 404 / 推送 deleted 事件，而不是报错
+from conftest import create_match, fa
+
+
+def deleted_after_etag(client, monkeypatch):
+    # 模拟读取 ETag 与读取比分之间比赛被删除：ETag 仍按删除前返回
+    match_id, _ = create_match(client, player_count=4)
+    with fa.app.app_context():
+        etag = fa.match_etag(match_id)
+    client.post(f'/delete_match/{match_id}')
+    monkeypatch.setattr(fa, 'match_etag', lambda requested_id: etag if requested_id == match_id else None)
+    return match_id
+
+
+def test_api_match_returns_404(client, monkeypatch):
+    match_id = deleted_after_etag(client, monkeypatch)
+    response = client.get(f'/api/match/{match_id}')
+    assert response.status_code == 404
+
+
+def test_event_stream_sends_deleted(client, monkeypatch):
+    match_id = deleted_after_etag(client, monkeypatch)
+    response = client.get(f'/api/match/{match_id}/events')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == 'event: deleted\ndata: {}\n\n'
@@ -0,0 +1,49 @@
+# 比赛详情页的查询次数与轮数无关（一次加载比赛、选手、汇总与逐轮记录，缺失的轮次成绩表一次查询）
+import pytest
+
+from conftest import count_queries, create_match, fa, round_form
+
+
+def detail_queries(client, match_id):
+    with count_queries() as statements:
+        response = client.get(f'/match/{match_id}')
+    assert response.status_code == 200
+    return len(statements)
+
+
+def played_match(client, rounds, finish):
+    match_id, player_ids = create_match(client)
+    for round_number in range(1, rounds + 1):
+        # 每轮轮换名次，各轮成绩表内容不同
+        order = player_ids[round_number % len(player_ids):] + player_ids[:round_number % len(player_ids)]
+        client.post(f'/match/{match_id}', data=round_form(order, round_number))
+    if finish:
+        client.post(f'/match/{match_id}', data={'end_match': '1'})
+    client.get(f'/match/{match_id}')  # 显示并清空录入时的提示信息
+    with fa.app.app_context():
+        assert fa.db.session.get(fa.MatchResult, match_id).rounds == rounds
+    return match_id
+
+
+@pytest.mark.parametrize('finish', [False, True])
+def test_query_count_does_not_grow_with_rounds(client, finish):
+    short = played_match(client, 1, finish)
+    long = played_match(client, 40, finish)
+
+    # 缓存为空：所有轮次的成绩表在一次查询中取出
+    fa.round_fragments.clear()
+    cold = [detail_queries(client, short), detail_queries(client, long)]
+    # 缓存命中：已录入的轮次直接使用缓存，进行中比赛的最新一轮仍然查询
+    warm = [detail_queries(client, short), detail_queries(client, long)]
+
+    assert cold[0] == cold[1]
+    assert warm[0] == warm[1]
+    assert warm[1] <= cold[1]
+
+
+def test_cached_round_tables_match_fresh_render(client):
+    match_id = played_match(client, 12, True)
+    fa.round_fragments.clear()
+    cold = client.get(f'/match/{match_id}').get_data(as_text=True)
+    warm = client.get(f'/match/{match_id}').get_data(as_text=True)
+    assert cold == warm
@@ -0,0 +1,39 @@
+# 主页比赛列表的游标分页：顺序与按 (时间为空, 时间倒序, id) 排序一致，每页查询都是 ix_match_time_id 上的区间扫描
+from conftest import count_queries, create_match, fa
+
+
+def add_matches(client):
+    # 通过页面创建比赛（带汇总记录），其中一部分再把时间置空
+    for i in range(40):
+        match_id, _ = create_match(client, player_count=4, time=f'2023-03-{1 + i % 6:02d}T20:00')
+        if i % 9 == 0:
+            with fa.app.app_context():
+                fa.db.session.get(fa.Match, match_id).time = None
+                fa.db.session.commit()
+
+
+def test_pages_follow_list_order_and_use_index(client):
+    add_matches(client)
+    with fa.app.app_context():
+        expected = [match.id for match in
+                    fa.Match.query.order_by(fa.Match.time.is_(None), fa.Match.time.desc(), fa.Match.id)]
+
+    ids, cursor, statements = [], None, []
+    while True:
+        with count_queries() as page_statements:
+            page = client.get('/api/matches', query_string={'limit': 7, 'cursor': cursor} if cursor else {'limit': 7})
+        statements += page_statements
+        ids += [match['id'] for match in page.get_json()['matches']]
+        cursor = page.get_json()['next_cursor']
+        if cursor is None:
+            break
+    assert ids == expected
+
+    with fa.app.app_context():
+        connection = fa.db.session.connection().connection.driver_connection
+        for statement, parameters in statements:
+            if 'FROM match' not in statement.replace('"', ''):
+                continue
+            plan = ' '.join(row[3] for row in connection.execute(f'EXPLAIN QUERY PLAN {statement}', parameters))
+            assert 'TEMP B-TREE' not in plan
+            assert 'SEARCH match USING INDEX ix_match_time_id' in plan
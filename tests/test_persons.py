@@ -0,0 +1,36 @@
+# 两个请求同时引入同一位新选手时，后插入的一方读取已创建的选手身份，而不是因唯一约束失败
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from conftest import fa
+
+
+def test_person_created_concurrently():
+    name = '同时创建'
+    raced = []
+
+    def create_elsewhere():
+        with fa.app.app_context():
+            fa.db.session.add(fa.Person(name=name))
+            fa.db.session.commit()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # 本请求已确认选手不存在、即将插入时，另一个请求抢先创建并提交
+        if statement.startswith('INSERT INTO person') and threading.current_thread() is threading.main_thread() \
+                and not raced:
+            raced.append(True)
+            other = threading.Thread(target=create_elsewhere)
+            other.start()
+            other.join()
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        with fa.app.app_context():
+            person = fa.get_or_create_person(name)
+            fa.db.session.commit()
+            assert raced
+            assert fa.Person.query.filter_by(name=name).one().id == person.id
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
@@ -0,0 +1,28 @@
+# 结束比赛时增量计算的等级分与按时间顺序重放（rebuild_ratings）的结果一致，补录的旧比赛也一样
+import random
+
+from conftest import create_match, fa, round_form
+
+
+def stored_ratings():
+    with fa.app.app_context():
+        ratings = {(rating.person_id, rating.matches): round(rating.rating, 9) for rating in fa.PlayerRating.query}
+        history = {(row.match_id, row.person_id): (round(row.rating_before, 9), round(row.rating_after, 9))
+                   for row in fa.RatingHistory.query}
+        return ratings, history
+
+
+def test_ratings_match_replay_when_matches_end_out_of_order(client):
+    rng = random.Random(22)
+    for day in rng.sample(range(1, 29), 20):
+        match_id, player_ids = create_match(client, player_count=4, time=f'2024-02-{day:02d}T20:00')
+        for round_number in range(1, 4):
+            client.post(f'/match/{match_id}', data=round_form(rng.sample(player_ids, len(player_ids)), round_number))
+        client.post(f'/match/{match_id}', data={'end_match': '1'})
+
+    online = stored_ratings()
+    with fa.app.app_context():
+        fa.rebuild_ratings()
+        fa.db.session.commit()
+
+    assert stored_ratings() == online
@@ -0,0 +1,47 @@
+# 年度 / 生涯报告对任意年份参数都返回页面：超出可统计范围的年份显示无数据，生涯报告的年数有上限
+import datetime
+
+import pytest
+
+from conftest import fa
+
+
+@pytest.mark.parametrize('year', [0, -5, 9999, 10000])
+def test_annual_report_out_of_range_year(client, year):
+    page = client.get('/annual_report', query_string={'year': year})
+    assert page.status_code == 200
+    assert '暂无' in page.get_data(as_text=True)
+    assert (None, year) not in fa.report_cache._entries
+
+
+@pytest.mark.parametrize('start, end', [(0, 0), (9999, 9999)])
+def test_multi_year_report_out_of_range_years(client, start, end):
+    page = client.get('/multi_year_report', query_string={'start': start, 'end': end})
+    assert page.status_code == 200
+
+
+def test_multi_year_report_without_matches(client, monkeypatch):
+    # 没有比赛时不逐年生成汇总
+    monkeypatch.setattr(fa, 'match_time_range', lambda: (None, None))
+    with fa.app.app_context():
+        rollups = fa.YearRollup.query.count()
+    page = client.get('/multi_year_report', query_string={'start': 1, 'end': 9998})
+    assert page.status_code == 200
+    assert '暂无比赛数据' in page.get_data(as_text=True)
+    with fa.app.app_context():
+        assert fa.YearRollup.query.count() == rollups
+
+
+def test_requested_years_span_is_capped(monkeypatch):
+    monkeypatch.setitem(fa.app.config, 'REPORT_MAX_YEARS', 5)
+    first_time, last_time = datetime.datetime(1, 1, 1), datetime.datetime(9999, 6, 1)
+    with fa.app.test_request_context('/multi_year_report?start=-3&end=10000'):
+        assert fa.requested_years(first_time, last_time) == (9994, 9998)
+    with fa.app.test_request_context('/multi_year_report?start=2020&end=2022'):
+        assert fa.requested_years(first_time, last_time) == (2020, 2022)
+
+
+def test_report_cache_is_bounded_by_default(client):
+    for year in range(1900, 1900 + fa.app.config['REPORT_CACHE_SIZE'] + 10):
+        assert client.get('/annual_report', query_string={'year': year}).status_code == 200
+    assert len(fa.report_cache._entries) == fa.app.config['REPORT_CACHE_SIZE']
@@ -0,0 +1,90 @@
+# 同一轮成绩同时提交（或提交成绩与结束比赛同时发生）时只有一方成功，汇总表与原始成绩保持一致
+import threading
+
+from conftest import create_match, fa, round_form
+
+SCORERS = 6
+
+
+def run_together(targets):
+    # 各线程就绪后同时开始，返回各自的结果
+    barrier = threading.Barrier(len(targets))
+    results = [None] * len(targets)
+
+    def run(index, target):
+        results[index] = target(barrier.wait)
+
+    threads = [threading.Thread(target=run, args=(index, target)) for index, target in enumerate(targets)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def stored_rounds(match_id):
+    with fa.app.app_context():
+        result = fa.db.session.get(fa.MatchResult, match_id)
+        scores = fa.RoundScore.query.filter_by(match_id=match_id).count()
+        assert fa.check_match_results() == []
+        return result.rounds, scores, result.finalized
+
+
+def test_same_round_posted_by_six_scorers():
+    match_id, player_ids = create_match(fa.app.test_client())
+
+    def post(wait):
+        client = fa.app.test_client()
+        wait()
+        page = client.post(f'/match/{match_id}', data=round_form(player_ids, 1), follow_redirects=True)
+        return '本轮成绩录入成功' in page.get_data(as_text=True)
+
+    accepted = run_together([post] * SCORERS)
+
+    assert accepted.count(True) == 1
+    assert stored_rounds(match_id) == (1, len(player_ids), False)
+
+
+def test_stale_submissions_advance_one_round():
+    # 每个线程在其他线程写入之前读取比赛（轮次均为 0），只能由乐观锁拦下其余提交
+    match_id, player_ids = create_match(fa.app.test_client())
+
+    def submit(wait):
+        with fa.app.app_context():
+            match = fa.db.session.get(fa.Match, match_id)
+            match.result, match.players
+            wait()
+            return fa.submit_round(match, player_ids)
+
+    errors = run_together([submit] * SCORERS)
+
+    assert errors.count(None) == 1
+    assert stored_rounds(match_id) == (1, len(player_ids), False)
+
+
+def test_round_and_end_match_at_once():
+    match_id, player_ids = create_match(fa.app.test_client())
+    fa.app.test_client().post(f'/match/{match_id}', data=round_form(player_ids, 1))
+
+    def submit(wait):
+        with fa.app.app_context():
+            match = fa.db.session.get(fa.Match, match_id)
+            match.result, match.players
+            wait()
+            return fa.submit_round(match, player_ids)
+
+    def end(wait):
+        with fa.app.app_context():
+            match = fa.db.session.get(fa.Match, match_id)
+            match.result, match.players
+            wait()
+            return fa.end_match(match)
+
+    submitted, ended = run_together([submit, end])
+
+    assert [submitted, ended].count(None) == 1
+    rounds, scores, finalized = stored_rounds(match_id)
+    if ended is None:
+        assert (rounds, scores, finalized) == (1, len(player_ids), True)
+    else:
+        assert (rounds, scores, finalized) == (2, 2 * len(player_ids), False)
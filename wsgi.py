@@ -0,0 +1,14 @@
+# 生产环境入口：启用 PRODUCTION_CONFIG（SQLite WAL、连接池等），由多进程 WSGI 服务器加载
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#   python wsgi.py                       # 等价于上面的命令
+import os
+import sys
+
+os.environ.setdefault('GUANDAN_CONFIG', 'production')
+
+from flask_app import app  # noqa: E402
+
+if __name__ == '__main__':
+    from gunicorn.app.wsgiapp import run
+    sys.argv = ['gunicorn', '-c', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py'), 'wsgi:app']
+    run()